@@ -6,6 +6,10 @@ import sys
 import json
 from ..PoolDatabase.object import PoolDatabase
 from ..SateliteImages.object import PolygonPhotos
+from ..TileCache.object import TileCache
+from ..GeocodeCache.object import GeocodeCache
+from ..BoundaryStore.object import BoundaryStore
+from ..OverpassScheduler.object import OverpassScheduler
 from bson.objectid import ObjectId
 
 def convert(o):
@@ -16,10 +20,23 @@ def convert(o):
     raise TypeError
 
 class AdminServer:
-    def __init__(self, bing_key, machine_id):
+    def __init__(self, bing_key, machine_id, cache_dir=None, cache_size=None, cache_read_only=False,
+                 geocode_cache_path=None, geocode_precision=9, geocode_ttl=90 * 24 * 3600,
+                 osm_store_path=None, overpass_url=None, osm_offline=False, overpass_concurrency=2,
+                 db_uri=None, db_options=None):
         self.bing_key_file = bing_key
         with open(bing_key, 'r') as f:
             self.bing_key = f.read()
+        self.cache = TileCache(cache_dir, cache_size, cache_read_only) if cache_dir is not None else None
+        self.geocode_cache = GeocodeCache(geocode_cache_path, geocode_precision, geocode_ttl) \
+            if geocode_cache_path is not None else None
+        self.osm_store = BoundaryStore(osm_store_path) if osm_store_path is not None else None
+        self.overpass_url = overpass_url
+        self.overpass = OverpassScheduler(overpass_url, max_concurrent=overpass_concurrency)
+        self.osm_offline = osm_offline
+        if db_uri is not None or db_options:
+            # every PoolDatabase of the process (also in batches) shares client with these settings
+            PoolDatabase.configure(db_uri, **(db_options or {}))
         self.db = PoolDatabase(init_app=False)
         self.machine_id = machine_id
         self.db.close_tasks_for_machine(machine_id)
@@ -52,23 +69,60 @@ class AdminServer:
         @app.route("/batches", methods=['POST'])
         def add_batch():
             data = request.get_json()
-            pp = PolygonPhotos(data.get('nodes'), self.bing_key, data.get('zoomLevel'), data.get('width'), data.get('height'), data.get('name'))
+            pp = PolygonPhotos(data.get('nodes'), self.bing_key, data.get('zoomLevel'), data.get('width'), data.get('height'), data.get('name'), self.cache)
             pp.export_to_db()
             return Response(json.dumps({ 'ok': True }, default=convert), content_type='application/json')
 
         @app.route("/batches/<string:batch_id>/run", methods=["POST"])
         def run_batch(batch_id):
             data = request.get_json()
-            pp = PolygonPhotos.import_from_db(self.bing_key, batch_id)
+            pp = PolygonPhotos.import_from_db(self.bing_key, batch_id, self.cache)
             if pp is None:
                 abort(404)
-            pp.fit(data.get('coverage'), [data.get('sleep_min'), data.get('sleep_max')], self.machine_id)
+            pp.fit(data.get('coverage'), [data.get('sleep_min'), data.get('sleep_max')], self.machine_id,
+                   workers=data.get('workers') or 1, rate_limit=data.get('rate_limit'),
+                   max_retries=5 if data.get('max_retries') is None else int(data['max_retries']),
+                   lease_size=int(data.get('lease_size') or 15), lease_seconds=int(data.get('lease_seconds') or 300),
+                   detect_workers=data.get('detect_workers') or 1,
+                   geocode_workers=data.get('geocode_workers') or 1, queue_size=data.get('queue_size') or 16,
+                   detect_processes=data.get('detect_processes') or 0, adaptive_zoom=data.get('adaptive_zoom') or 0,
+                   dedupe_radius=data.get('dedupe_radius') or 0, geocode_rate_limit=data.get('geocode_rate_limit'),
+                   geocode_cache=self.geocode_cache, blob_method=data.get('blob_method') or 'contours')
             return Response(json.dumps({ 'ok': True }, default=convert), content_type='application/json')
+
+        @app.route("/batches/<string:batch_id>/leases", methods=["GET"])
+        def batch_leases(batch_id):
+            result = self.db.lease_summary(batch_id)
+            return Response(json.dumps(result, default=convert), content_type='application/json')
+
+        @app.route("/batches/<string:batch_id>/stats", methods=["GET"])
+        def batch_stats(batch_id):
+            result = self.db.get_batch(batch_id).get('pipeline_stats')
+            return Response(json.dumps(result, default=convert), content_type='application/json')
+
+        @app.route("/cache", methods=["GET"])
+        def cache_stats():
+            result = self.cache.stats() if self.cache is not None else None
+            return Response(json.dumps(result, default=convert), content_type='application/json')
+
+        @app.route("/geocode-cache", methods=["GET"])
+        def geocode_cache_stats():
+            result = self.geocode_cache.stats() if self.geocode_cache is not None else None
+            return Response(json.dumps(result, default=convert), content_type='application/json')
         
+        @app.route("/db-pool", methods=["GET"])
+        def db_pool_stats():
+            return Response(json.dumps(self.db.pool_stats(), default=convert), content_type='application/json')
+
+        @app.route("/overpass", methods=["GET"])
+        def overpass_stats():
+            return Response(json.dumps(self.overpass.stats(), default=convert), content_type='application/json')
+
         @app.route("/batches/<string:batch_id>/osm", methods=["POST"])
         def osm_batch(batch_id):
             pp = PolygonPhotos.import_from_db(self.bing_key, batch_id)
-            pp.get_osm_data(self.machine_id)
+            from ..PoolPolygonsFinder.object import PoolPolygonsFinder
+            pp.get_osm_data(self.machine_id, PoolPolygonsFinder(self.overpass_url, self.osm_store, self.osm_offline, self.overpass))
             return Response(json.dumps({ 'ok': True }, default=convert), content_type='application/json')
 
         @app.route("/batches/<string:batch_id>", methods=["DELETE"])
@@ -0,0 +1,150 @@
+import json
+import math
+import sqlite3
+import threading
+import time
+
+
+class BoundaryStore:
+
+    def __init__(self, path):
+        """Boundary Store
+        Persistent store of OSM administrative boundaries in SQLite file. Relations are kept
+        with assembled rings and their bounding box, so pools can be assigned to them without
+        Overpass. Store remembers which 1 x 1 degree cells were fetched at which admin levels.
+
+        Parameters
+        ----------
+        path : string
+            path to the SQLite database file, created if missing
+
+        Returns
+        -------
+        BoundaryStore object
+        """
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.executescript('''
+            CREATE TABLE IF NOT EXISTS relations (
+                id INTEGER PRIMARY KEY, level TEXT, name TEXT, rings TEXT NOT NULL,
+                min_lat REAL, max_lat REAL, min_lon REAL, max_lon REAL, fetched REAL);
+            CREATE INDEX IF NOT EXISTS relations_bbox ON relations (level, min_lat, max_lat, min_lon, max_lon);
+            CREATE TABLE IF NOT EXISTS cells (
+                lat INTEGER, lon INTEGER, level TEXT, fetched REAL, PRIMARY KEY (lat, lon, level));
+        ''')
+        self.connection.commit()
+
+    @staticmethod
+    def cells(lat_range, lon_range):
+        """
+        Returns list of (lat, lon) corners of 1 x 1 degree cells covering given ranges.
+        """
+        return [(lat, lon)
+                for lat in range(math.floor(lat_range[0]), math.floor(lat_range[1]) + 1)
+                for lon in range(math.floor(lon_range[0]), math.floor(lon_range[1]) + 1)]
+
+    @staticmethod
+    def rectangles(cells):
+        """
+        Groups cells into rectangles. Returns list of ([min_lat, max_lat], [min_lon, max_lon]) corners
+        of cells of every rectangle. Neighbouring cells of a row are joined first, then equal runs of
+        consecutive rows.
+        """
+        runs = []
+        for lat, lon in sorted(set(cells)):
+            if runs and runs[-1][0] == lat and runs[-1][2] == lon - 1:
+                runs[-1][2] = lon
+            else:
+                runs.append([lat, lon, lon])
+        rectangles = {}
+        for lat, min_lon, max_lon in runs:
+            rect = rectangles.get((lat - 1, min_lon, max_lon))
+            if rect is not None:
+                del rectangles[(lat - 1, min_lon, max_lon)]
+                rect[0][1] = lat
+            else:
+                rect = ([lat, lat], [min_lon, max_lon])
+            rectangles[(lat, min_lon, max_lon)] = rect
+        return sorted(rectangles.values())
+
+    def missing_cells(self, cells, levels):
+        """
+        Returns cells (from given list) which were not fetched at all given levels yet.
+        """
+        if len(cells) == 0:
+            return []
+        levels = [str(level) for level in levels]
+        lats = [cell[0] for cell in cells]
+        lons = [cell[1] for cell in cells]
+        with self.lock:
+            rows = self.connection.execute(
+                f"SELECT lat, lon FROM cells WHERE lat BETWEEN ? AND ? AND lon BETWEEN ? AND ? "
+                f"AND level IN ({','.join('?' * len(levels))}) GROUP BY lat, lon HAVING COUNT(*) = ?",
+                [min(lats), max(lats), min(lons), max(lons)] + levels + [len(set(levels))]).fetchall()
+        fetched = set(rows)
+        return [(lat, lon) for lat, lon in cells if (lat, lon) not in fetched]
+
+    def mark_cells(self, cells, levels):
+        """
+        Remembers that all boundaries of given levels in cells are stored.
+        """
+        now = time.time()
+        with self.lock:
+            self.connection.executemany('INSERT OR REPLACE INTO cells (lat, lon, level, fetched) VALUES (?, ?, ?, ?)',
+                                        [(lat, lon, str(level), now) for lat, lon in cells for level in levels])
+            self.connection.commit()
+
+    def put_relations(self, relations):
+        """
+        Stores relations given as dictionaries with id, level, name and rings (lists of (lat, lon) tuples).
+        """
+        now = time.time()
+        rows = []
+        for rel in relations:
+            points = [point for ring in rel['rings'] for point in ring]
+            lats = [point[0] for point in points] or [None]
+            lons = [point[1] for point in points] or [None]
+            rows.append((rel['id'], None if rel.get('level') is None else str(rel['level']), rel.get('name'),
+                         json.dumps(rel['rings']), min(lats), max(lats), min(lons), max(lons), now))
+        with self.lock:
+            self.connection.executemany('INSERT OR REPLACE INTO relations '
+                                        '(id, level, name, rings, min_lat, max_lat, min_lon, max_lon, fetched) '
+                                        'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+            self.connection.commit()
+
+    @staticmethod
+    def _relation(row):
+        return { 'id': row[0], 'level': row[1], 'name': row[2], 'rings': [list(map(tuple, ring)) for ring in json.loads(row[3])] }
+
+    def relations_in_bbox(self, lat_range, lon_range, level):
+        """
+        Returns relations of given admin level whose bounding box intersects given ranges, ordered by id.
+        """
+        with self.lock:
+            rows = self.connection.execute(
+                'SELECT id, level, name, rings FROM relations WHERE level = ? AND min_lat <= ? AND max_lat >= ? '
+                'AND min_lon <= ? AND max_lon >= ? ORDER BY id',
+                (str(level), lat_range[1], lat_range[0], lon_range[1], lon_range[0])).fetchall()
+        return [self._relation(row) for row in rows]
+
+    def get_relations(self, ids):
+        """
+        Returns stored relations with given ids (missing ones are left out), ordered by id.
+        """
+        ids = [int(rel_id) for rel_id in ids]
+        relations = []
+        with self.lock:
+            for start in range(0, len(ids), 500):
+                chunk = ids[start:start + 500]
+                relations += self.connection.execute(
+                    f"SELECT id, level, name, rings FROM relations WHERE id IN ({','.join('?' * len(chunk))})",
+                    chunk).fetchall()
+        return [self._relation(row) for row in sorted(relations)]
+
+    def close(self):
+        """
+        Closes the database file.
+        """
+        with self.lock:
+            self.connection.close()
@@ -5,7 +5,6 @@ import logging
 import sys
 import json
 from ..PoolDatabase.object import PoolDatabase
-from ..SateliteImages.object import PolygonPhotos
 from bson.objectid import ObjectId
 
 def convert(o):
@@ -0,0 +1,134 @@
+import json
+import sqlite3
+import threading
+import time
+from ..PoolAddressParser.utils import geohash
+
+
+class GeocodeCache:
+
+    def __init__(self, path, precision=9, ttl=90 * 24 * 3600):
+        """Geocode Cache
+        Persistent cache of reverse-geocoded addresses stored in SQLite file. Coordinates are
+        quantized to geohash cells, so all pools lying in one cell share one lookup.
+
+        Parameters
+        ----------
+        path : string
+            path to the SQLite database file, created if missing
+        precision : integer
+            length of geohash of cells, 9 means cells of about 5 x 5 meters
+        ttl : double
+            time in seconds after which cached address is fetched again, None means forever
+
+        Returns
+        -------
+        GeocodeCache object
+        """
+        self.path = path
+        self.precision = precision
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS addresses '
+                                '(cell TEXT PRIMARY KEY, address TEXT NOT NULL, created REAL NOT NULL)')
+        self.connection.commit()
+
+    def cell(self, lat, long):
+        """
+        Returns geohash cell of the coordinates.
+        """
+        return geohash(lat, long, self.precision)
+
+    def _get(self, cell):
+        row = self.connection.execute('SELECT address, created FROM addresses WHERE cell = ?', (cell,)).fetchone()
+        if row is None or (self.ttl is not None and row[1] < time.time() - self.ttl):
+            return None
+        return json.loads(row[0])
+
+    def get(self, cell):
+        """
+        Returns cached address of the cell or None if it is missing or expired.
+        """
+        with self.lock:
+            address = self._get(cell)
+            if address is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return address
+
+    def put(self, cell, address):
+        """
+        Stores address of the cell.
+        """
+        with self.lock:
+            self.connection.execute('INSERT OR REPLACE INTO addresses (cell, address, created) VALUES (?, ?, ?)',
+                                    (cell, json.dumps(address), time.time()))
+            self.connection.commit()
+
+    def get_or_fetch(self, cell, fetch):
+        """
+        Returns cached address of the cell, calls fetch() and stores its result (if not None) on miss.
+        Threads asking for the same missing cell at once wait for the single fetch.
+        """
+        while True:
+            with self.lock:
+                address = self._get(cell)
+                if address is not None:
+                    self.hits += 1
+                    return address
+                event = self.pending.get(cell)
+                if event is None:
+                    self.pending[cell] = threading.Event()
+                    self.misses += 1
+                    break
+                self.coalesced += 1
+            # fetch of other thread finished, cell is cached now or that fetch failed and this one repeats it
+            event.wait()
+        try:
+            address = fetch()
+            if address is not None:
+                self.put(cell, address)
+            return address
+        finally:
+            with self.lock:
+                self.pending.pop(cell).set()
+
+    def purge(self):
+        """
+        Removes expired entries. Returns amount of removed entries.
+        """
+        if self.ttl is None:
+            return 0
+        with self.lock:
+            removed = self.connection.execute('DELETE FROM addresses WHERE created < ?', (time.time() - self.ttl,)).rowcount
+            self.connection.commit()
+            return removed
+
+    def stats(self):
+        """
+        Returns dictionary with hits, misses, hit rate, amount of lookups which waited for
+        the same cell fetched by other thread (coalesced) and amount of entries.
+        """
+        with self.lock:
+            requests = self.hits + self.misses
+            entries = self.connection.execute('SELECT COUNT(*) FROM addresses').fetchone()[0]
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / requests if requests else 0,
+                'coalesced': self.coalesced,
+                'entries': entries
+            }
+
+    def close(self):
+        """
+        Closes the database file.
+        """
+        with self.lock:
+            self.connection.close()
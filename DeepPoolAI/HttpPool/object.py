@@ -0,0 +1,168 @@
+import http.client
+import random
+import threading
+import time
+from urllib.error import HTTPError
+from urllib.parse import urljoin, urlsplit
+
+
+class TokenBucket:
+
+    def __init__(self, rate, capacity=None):
+        """Token Bucket
+        Thread safe limiter of requests per second.
+
+        Parameters
+        ----------
+        rate : double
+            amount of tokens added to the bucket every second
+        capacity : integer
+            maximal amount of stored tokens (burst size), defaults to max(1, rate)
+
+        Returns
+        -------
+        TokenBucket object
+        """
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else max(1, rate))
+        self.tokens = self.capacity
+        self.timestamp = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Blocks until one token is available and takes it.
+        """
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.timestamp) * self.rate)
+                self.timestamp = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class HttpPool:
+    retry_statuses = (429, 500, 502, 503, 504)
+
+    def __init__(self, max_connections=8, rate_limit=None, max_retries=5, backoff=0.5, max_backoff=60, timeout=30):
+        """Http Pool
+        Keep-alive HTTP(S) connections shared between threads. Requests are limited
+        by token bucket and retried with exponential backoff on 429/5xx responses and network errors.
+
+        Parameters
+        ----------
+        max_connections : integer
+            maximal amount of idle connections kept for every host
+        rate_limit : double
+            maximal amount of requests per second, None disables limit
+        max_retries : integer
+            how many times request is repeated before error is raised
+        backoff : double
+            first backoff delay in seconds, doubled after every failed attempt
+        max_backoff : double
+            upper bound of single backoff delay in seconds
+        timeout : double
+            socket timeout in seconds
+
+        Returns
+        -------
+        HttpPool object
+        """
+        self.max_connections = max_connections
+        self.bucket = TokenBucket(rate_limit) if rate_limit else None
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.idle = {}
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.retries = 0
+
+    def _take(self, scheme, netloc):
+        with self.lock:
+            connections = self.idle.get((scheme, netloc))
+            if connections:
+                return connections.pop()
+        if scheme == 'https':
+            return http.client.HTTPSConnection(netloc, timeout=self.timeout)
+        return http.client.HTTPConnection(netloc, timeout=self.timeout)
+
+    def _give_back(self, scheme, netloc, connection):
+        with self.lock:
+            connections = self.idle.setdefault((scheme, netloc), [])
+            if len(connections) < self.max_connections:
+                connections.append(connection)
+                return
+        connection.close()
+
+    def _delay(self, attempt, retry_after=None):
+        if retry_after is not None and retry_after.isdigit():
+            return min(float(retry_after), self.max_backoff)
+        delay = min(self.backoff * 2 ** attempt, self.max_backoff)
+        return random.uniform(delay / 2, delay)
+
+    def get(self, url, max_redirects=5):
+        """ Get
+        Downloads content of given url.
+
+        Parameters
+        ----------
+        url : string
+            http or https url
+
+        Returns
+        -------
+        Response body as bytes. Raises urllib.error.HTTPError if request finally failed.
+        """
+        for attempt in range(self.max_retries + 1):
+            parts = urlsplit(url)
+            path = parts.path or '/'
+            if parts.query:
+                path += '?' + parts.query
+            if self.bucket is not None:
+                self.bucket.acquire()
+            connection = self._take(parts.scheme, parts.netloc)
+            try:
+                connection.request('GET', path, headers={'Connection': 'keep-alive'})
+                response = connection.getresponse()
+                body = response.read()
+            except (http.client.HTTPException, OSError):
+                connection.close()
+                if attempt == self.max_retries:
+                    raise
+                with self.lock:
+                    self.retries += 1
+                time.sleep(self._delay(attempt))
+                continue
+            with self.lock:
+                self.requests += 1
+            if response.will_close:
+                connection.close()
+            else:
+                self._give_back(parts.scheme, parts.netloc, connection)
+            if response.status in (301, 302, 303, 307, 308) and max_redirects > 0:
+                return self.get(urljoin(url, response.getheader('Location')), max_redirects - 1)
+            if response.status in self.retry_statuses and attempt < self.max_retries:
+                with self.lock:
+                    self.retries += 1
+                time.sleep(self._delay(attempt, response.getheader('Retry-After')))
+                continue
+            if response.status >= 400:
+                raise HTTPError(url, response.status, response.reason, response.headers, None)
+            return body
+
+    def close(self):
+        """
+        Closes all idle connections.
+        """
+        with self.lock:
+            idle = self.idle
+            self.idle = {}
+        for connections in idle.values():
+            for connection in connections:
+                connection.close()
@@ -0,0 +1,283 @@
+import overpy
+import random
+import threading
+import time
+from collections import deque
+
+
+class _Query:
+
+    def __init__(self, text=None, lat=None, lon=None, levels=None, build=None):
+        self.text = text
+        self.lat = lat
+        self.lon = lon
+        self.levels = levels
+        self.build = build
+        self.started = False
+        self.finished = None
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+    def level_set(self):
+        return set(self.levels) if type(self.levels) is list else { self.levels }
+
+    def covers(self, lat, lon, levels):
+        return self.lat[0] <= lat[0] and lat[1] <= self.lat[1] and self.lon[0] <= lon[0] and lon[1] <= self.lon[1] \
+            and self.level_set() >= levels
+
+    def overlaps(self, lat, lon):
+        return self.lat[0] <= lat[1] and lat[0] <= self.lat[1] and self.lon[0] <= lon[1] and lon[0] <= self.lon[1]
+
+
+class OverpassScheduler:
+    _shared = {}
+    _shared_lock = threading.Lock()
+
+    def __init__(self, url=None, max_concurrent=2, max_retries=6, backoff=2, max_backoff=120, ttl=300,
+                 max_recent=8, max_merge_area=16):
+        """Overpass Scheduler
+        Runs Overpass queries shared by many threads (e.g. osm assignment of concurrent batches).
+        At most max_concurrent requests are sent at once, rejected (429, 504, 5xx) and failed requests
+        are retried with exponential backoff with jitter. Identical queries which are running or finished
+        less than ttl seconds ago are answered with the same result. Bbox query lying inside running or
+        recent one waits for it and queued bbox queries overlapping each other are merged into one.
+
+        Parameters
+        ----------
+        url : string
+            Overpass API url, defaults to the public instance
+        max_concurrent : integer
+            maximal amount of requests sent at once
+        max_retries : integer
+            how many times request is repeated before error is raised
+        backoff : double
+            first backoff delay in seconds, doubled after every failed attempt
+        max_backoff : double
+            upper bound of single backoff delay in seconds
+        ttl : double
+            how long in seconds results of finished queries are reused
+        max_recent : integer
+            maximal amount of finished queries kept for reuse, results of bbox queries of whole
+            regions may take tens of megabytes each
+        max_merge_area : double
+            maximal area (in square degrees) of bbox of merged queries, None disables merging
+
+        Returns
+        -------
+        OverpassScheduler object
+        """
+        self.api = overpy.Overpass(url=url)
+        self.url = self.api.url
+        self.max_concurrent = max_concurrent
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.ttl = ttl
+        self.max_recent = max_recent
+        self.max_merge_area = max_merge_area
+        self.slots = threading.Semaphore(max_concurrent)
+        self.lock = threading.Lock()
+        self.queries = []
+        self.submitted = 0
+        self.coalesced = 0
+        self.covered = 0
+        self.merged = 0
+        self.requests = 0
+        self.retries = 0
+        self.errors = 0
+        self.queued = 0
+        self.max_queued = 0
+        self.running = 0
+        self.waits = deque(maxlen=1000)
+        self.latencies = deque(maxlen=1000)
+
+    @classmethod
+    def shared(cls, url=None):
+        """
+        Returns scheduler of the url shared by the whole process, created with default parameters on first use.
+        """
+        with cls._shared_lock:
+            scheduler = cls._shared.get(url)
+            if scheduler is None:
+                scheduler = cls._shared[url] = cls(url)
+            return scheduler
+
+    def _delay(self, attempt):
+        delay = min(self.backoff * 2 ** attempt, self.max_backoff)
+        return random.uniform(delay / 2, delay)
+
+    @staticmethod
+    def _retryable(error):
+        if isinstance(error, overpy.exception.OverpassUnknownHTTPStatusCode):
+            return error.code >= 500
+        return isinstance(error, (overpy.exception.OverpassTooManyRequests,
+                                  overpy.exception.OverpassGatewayTimeout, OSError))
+
+    def _send(self, text):
+        for attempt in range(self.max_retries + 1):
+            with self.lock:
+                self.requests += 1
+            try:
+                return self.api.query(text)
+            except Exception as e:
+                if attempt == self.max_retries or not self._retryable(e):
+                    raise
+                with self.lock:
+                    self.retries += 1
+            time.sleep(self._delay(attempt))
+
+    def _prune(self):
+        now = time.monotonic()
+        finished = [q for q in self.queries if q.finished is not None]
+        expired = set(id(q) for q in finished if self.ttl is None or now - q.finished > self.ttl)
+        finished = [q for q in finished if id(q) not in expired]
+        expired.update(id(q) for q in finished[:max(0, len(finished) - self.max_recent)])
+        self.queries = [q for q in self.queries if id(q) not in expired]
+
+    def _run(self, query):
+        queued = time.monotonic()
+        with self.lock:
+            self.queued += 1
+            self.max_queued = max(self.max_queued, self.queued)
+        self.slots.acquire()
+        start = None
+        try:
+            with self.lock:
+                self.queued -= 1
+                self.running += 1
+                # bbox of started query is final, no more queries are merged into it
+                query.started = True
+                if query.text is None:
+                    query.text = query.build(query.lat, query.lon, query.levels)
+            start = time.monotonic()
+            query.result = self._send(query.text)
+        except BaseException as e:
+            query.error = e
+        finally:
+            self.slots.release()
+            with self.lock:
+                self.running -= 1
+                query.finished = time.monotonic()
+                if start is not None:
+                    self.waits.append(start - queued)
+                    self.latencies.append(query.finished - start)
+                if query.error is not None:
+                    self.errors += 1
+                    self.queries.remove(query)
+                self._prune()
+            query.done.set()
+        return self._wait(query)
+
+    @staticmethod
+    def _wait(query):
+        query.done.wait()
+        if query.error is not None:
+            raise query.error
+        return query.result
+
+    def query(self, text):
+        """ Query
+        Runs Overpass query, waits if the same query is already running.
+
+        Parameters
+        ----------
+        text : string
+            query in Overpass QL
+
+        Returns
+        -------
+        overpy.Result of the query
+        """
+        normalized = ' '.join(text.split())
+        with self.lock:
+            self.submitted += 1
+            self._prune()
+            own = None
+            for query in self.queries:
+                if query.text is not None and ' '.join(query.text.split()) == normalized:
+                    self.coalesced += 1
+                    break
+            else:
+                query = own = _Query(text=text)
+                self.queries.append(query)
+        if own is not None:
+            return self._run(own)
+        return self._wait(query)
+
+    def bbox_query(self, lat, lon, levels, build):
+        """ Bbox Query
+        Runs Overpass query of relations of given levels in bbox. Result may contain more relations
+        (of bigger bbox or more levels) if the query was answered by running, recent or merged query.
+
+        Parameters
+        ----------
+        lat : list
+            List with range of latitude
+        lon : list
+            List with range of longitude
+        levels : int or list
+            Administrative level or list of levels
+        build : function
+            build(lat, lon, levels) returns text of the query
+
+        Returns
+        -------
+        overpy.Result of the query
+        """
+        lat = [float(lat[0]), float(lat[1])]
+        lon = [float(lon[0]), float(lon[1])]
+        level_set = set(levels) if type(levels) is list else { levels }
+        with self.lock:
+            self.submitted += 1
+            self._prune()
+            own = None
+            for query in self.queries:
+                if query.lat is not None and query.covers(lat, lon, level_set):
+                    self.covered += 1
+                    break
+            else:
+                for query in self.queries:
+                    if query.lat is None or query.started or query.level_set() != level_set \
+                            or not query.overlaps(lat, lon):
+                        continue
+                    merged_lat = [min(lat[0], query.lat[0]), max(lat[1], query.lat[1])]
+                    merged_lon = [min(lon[0], query.lon[0]), max(lon[1], query.lon[1])]
+                    area = (merged_lat[1] - merged_lat[0]) * (merged_lon[1] - merged_lon[0])
+                    if self.max_merge_area is not None and area <= self.max_merge_area:
+                        query.lat, query.lon = merged_lat, merged_lon
+                        self.merged += 1
+                        break
+                else:
+                    query = own = _Query(lat=lat, lon=lon, levels=levels, build=build)
+                    self.queries.append(query)
+        if own is not None:
+            return self._run(own)
+        return self._wait(query)
+
+    def stats(self):
+        """
+        Returns dictionary with amount of submitted queries, queries answered by other ones (coalesced
+        identical, covered by bigger bbox and merged bbox), sent requests, retries, errors, current and
+        maximal amount of queries waiting for free slot, running requests, and waiting and request latency in seconds.
+        """
+        with self.lock:
+            waits = sorted(self.waits)
+            latencies = sorted(self.latencies)
+            return {
+                'submitted': self.submitted,
+                'coalesced': self.coalesced,
+                'covered': self.covered,
+                'merged': self.merged,
+                'requests': self.requests,
+                'retries': self.retries,
+                'errors': self.errors,
+                'queued': self.queued,
+                'max_queued': self.max_queued,
+                'running': self.running,
+                'wait_mean': sum(waits) / len(waits) if waits else 0,
+                'wait_max': waits[-1] if waits else 0,
+                'latency_mean': sum(latencies) / len(latencies) if latencies else 0,
+                'latency_p95': latencies[int(0.95 * (len(latencies) - 1))] if latencies else 0,
+                'latency_max': latencies[-1] if latencies else 0
+            }
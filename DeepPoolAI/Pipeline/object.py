@@ -0,0 +1,192 @@
+import queue
+import threading
+import time
+
+_DONE = object()
+
+
+class Stage:
+
+    def __init__(self, name, func, workers=1, queue_size=16, ordered=False):
+        """Stage
+        One step of the pipeline. Items from the input queue are processed by
+        worker threads with func and results are passed to the next stage.
+
+        Parameters
+        ----------
+        name : string
+            name of the stage used in statistics
+        func : function
+            function called on every item, its result is passed to the next stage
+        workers : integer
+            amount of worker threads
+        queue_size : integer
+            capacity of the input queue, full queue blocks previous stage (backpressure)
+        ordered : boolean
+            if True, items are processed in the order of the source. Requires single worker.
+
+        Returns
+        -------
+        Stage object
+        """
+        if ordered and workers != 1:
+            raise Exception('Ordered stage must have exactly one worker')
+        self.name = name
+        self.func = func
+        self.workers = max(1, workers)
+        self.ordered = ordered
+        self.input = queue.Queue(maxsize=queue_size)
+        self.processed = 0
+        self.busy = 0
+        self.max_depth = 0
+        self.running = 0
+        self.lock = threading.Lock()
+
+    def stats(self, elapsed):
+        """
+        Returns dictionary with amount of processed items, throughput (items per second of pipeline run),
+        utilization of workers and current and maximal depth of the input queue.
+        """
+        with self.lock:
+            return {
+                'workers': self.workers,
+                'processed': self.processed,
+                'throughput': self.processed / elapsed if elapsed > 0 else 0,
+                'utilization': self.busy / (elapsed * self.workers) if elapsed > 0 else 0,
+                'queue_depth': self.input.qsize(),
+                'max_queue_depth': self.max_depth
+            }
+
+
+class Pipeline:
+
+    def __init__(self, stages):
+        """Pipeline
+        Streaming pipeline of stages connected with bounded queues. Every stage has own
+        worker threads, so network bound and CPU bound stages overlap.
+
+        Parameters
+        ----------
+        stages : list
+            list of Stage objects
+
+        Returns
+        -------
+        Pipeline object
+        """
+        self.stages = stages
+        self.output = queue.Queue(maxsize=stages[-1].input.maxsize)
+        self.stop = threading.Event()
+        self.error = None
+        self.started = None
+
+    def _put(self, target, item):
+        while not self.stop.is_set():
+            try:
+                target.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _get(self, source):
+        while not self.stop.is_set():
+            try:
+                return source.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return _DONE
+
+    def _fail(self, error):
+        if self.error is None:
+            self.error = error
+        self.stop.set()
+
+    def _feed(self, items):
+        try:
+            for seq, item in enumerate(items):
+                if not self._put(self.stages[0].input, (seq, item)):
+                    return
+            self._put(self.stages[0].input, _DONE)
+        except BaseException as e:
+            self._fail(e)
+
+    def _work(self, stage, target):
+        pending = {}
+        next_seq = 0
+        last = False
+        try:
+            while True:
+                entry = self._get(stage.input)
+                if entry is _DONE:
+                    with stage.lock:
+                        stage.running -= 1
+                        last = stage.running == 0
+                    if not last:
+                        # let other workers of the stage finish too
+                        self._put(stage.input, _DONE)
+                    break
+                with stage.lock:
+                    stage.max_depth = max(stage.max_depth, stage.input.qsize() + 1)
+                if stage.ordered:
+                    pending[entry[0]] = entry[1]
+                    entries = []
+                    while next_seq in pending:
+                        entries.append((next_seq, pending.pop(next_seq)))
+                        next_seq += 1
+                else:
+                    entries = [entry]
+                for seq, item in entries:
+                    start = time.perf_counter()
+                    result = stage.func(item)
+                    with stage.lock:
+                        stage.busy += time.perf_counter() - start
+                        stage.processed += 1
+                    if not self._put(target, (seq, result)):
+                        return
+        except BaseException as e:
+            self._fail(e)
+        if last and self.error is None:
+            self._put(target, _DONE)
+
+    def run(self, items):
+        """ Run
+        Streams items through all stages.
+
+        Parameters
+        ----------
+        items : iterable
+            source of items, consumed in a separate thread
+
+        Returns
+        -------
+        Generator of results of the last stage. If any stage fails, its exception is raised here.
+        """
+        self.started = time.perf_counter()
+        threads = [threading.Thread(target=self._feed, args=(items,), daemon=True)]
+        for index, stage in enumerate(self.stages):
+            target = self.stages[index + 1].input if index + 1 < len(self.stages) else self.output
+            stage.running = stage.workers
+            threads += [threading.Thread(target=self._work, args=(stage, target), daemon=True)
+                        for _ in range(stage.workers)]
+        for thread in threads:
+            thread.start()
+        try:
+            while True:
+                entry = self._get(self.output)
+                if entry is _DONE:
+                    break
+                yield entry[1]
+        finally:
+            self.stop.set()
+            for thread in threads:
+                thread.join()
+        if self.error is not None:
+            raise self.error
+
+    def stats(self):
+        """
+        Returns dictionary of statistics of every stage.
+        """
+        elapsed = time.perf_counter() - self.started if self.started is not None else 0
+        return { stage.name: stage.stats(elapsed) for stage in self.stages }
@@ -1,26 +1,105 @@
 import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from urllib.request import urlopen
-from IPython.display import clear_output
-import pandas as pd
-import dicttoxml
-from xml.dom.minidom import parseString
+from .utils import write_json, write_jsonl, write_csv, write_xml, write_txt
 
 class PoolAddressParser:
 
-    def __init__(self, key):
+    def __init__(self, key, http=None, workers=1, cache=None):
         """
 
         Parameters
         ----------
         key : string
             Bing API key
+        http : HttpPool
+            optional pool of keep-alive connections (with rate limit and retries) used instead of urlopen
+        workers : integer
+            amount of concurrent requests made by geocode_many
+        cache : GeocodeCache
+            optional persistent cache of addresses, pools in the same cell share one lookup
         """
         self.key = key
         self.addresses = []
+        self.http = http
+        self.workers = max(1, workers)
+        self.executor = None
+        self.lock = threading.Lock()
+        self.cache = cache
+
+    def _download(self, request_url):
+        if self.http is None:
+            return urlopen(request_url).read()
+        return self.http.get(request_url)
+
+    def _get_address(self, coord):
+        request_url = f"http://dev.virtualearth.net/REST/v1/Locations/{coord[0]},{coord[1]}?o&key={self.key}"
+        response_json = json.loads(self._download(request_url))
+        if response_json["statusCode"] != 200:
+            return None
+        return response_json['resourceSets'][0]['resources'][0]['address']
+
+    def _lookup(self, coord):
+        if self.cache is None:
+            return self._get_address(coord)
+        return self.cache.get_or_fetch(self.cache.cell(coord[0], coord[1]), lambda: self._get_address(coord))
+
+    def _geocode(self, coord):
+        try:
+            address = self._lookup(coord)
+        except Exception as e:
+            return { "coordinates": coord, "address": None, "error": f"{type(e).__name__}: {e}" }
+        if address is None:
+            return { "coordinates": coord, "address": None, "error": "Address not found" }
+        return { "coordinates": coord, "address": address }
+
+    def geocode_many(self, pools_coord: list):
+        """ Reverse-geocodes many lat long coordinates at once with up to 'workers' concurrent requests.
+        Can be called from many threads, they share the same workers.
+
+        Parameters
+        ----------
+        pools_coord : list
+            This list should contain lat long coordinates of detected pools.
+
+        Returns
+        -------
+        pools_addresses: list
+            One item for every coordinate, in order of 'pools_coord'. Failed items have
+            address None and description of the problem in 'error'.
+            Example:
+                    [{
+                        "coordinates": [36.2798, -115.1672],
+                        "address": { "formattedAddress": "6513 Summer Bluff Ct, North Las Vegas, NV 89084", ... }
+                    },
+                    {
+                        "coordinates": [36.2801, -115.1675],
+                        "address": None,
+                        "error": "HTTPError: HTTP Error 503: Service Unavailable"
+                    }]
+        """
+        with self.lock:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=self.workers)
+        return list(self.executor.map(self._geocode, pools_coord))
+
+    def close(self):
+        """
+        Stops workers of geocode_many and closes connections of http pool.
+        """
+        with self.lock:
+            executor = self.executor
+            self.executor = None
+        if executor is not None:
+            executor.shutdown()
+        if self.http is not None:
+            self.http.close()
 
     def get_addresses(self, pools_coord: list, verbose: bool):
         """ Uses bing api to reverse-geocode lat long coordinates to usable addresses. If API responds with status
         code different than 200 (success), this lat long coordinate is skipped and counted as an error.
+        If parser has a cache, addresses of already geocoded cells are taken from it.
 
         Parameters
         ----------
@@ -58,20 +137,19 @@ class PoolAddressParser:
         _errors = 0
         n = len(pools_coord)
         for i in range(n):
-            request_url = f"http://dev.virtualearth.net/REST/v1/Locations/{pools_coord[i][0]},{pools_coord[i][1]}?o&key={self.key}"
-            request = urlopen(request_url)
-
-            response_json = json.loads(request.read())
-            if response_json["statusCode"] == 200:
+            address = self._lookup(pools_coord[i])
+            if address is not None:
                 pool_data = {
                     "coordinates": pools_coord[i],
-                    "address": response_json['resourceSets'][0]['resources'][0]['address']
+                    "address": address
                 }
                 pools_addresses.append(pool_data)
             elif verbose:
                 _errors += 1
 
             if verbose:
+                # IPython is imported only when progress is displayed
+                from IPython.display import clear_output
                 clear_output(wait=True)
                 print(f"Reverse-geocoding progress {round(((i+1)/n)*100,1)}%  {i+1}/{n}")
                 print("[{:<50}]".format("#"*(round((i+1)/n*100)//2)))
@@ -89,9 +167,10 @@ class PoolAddressParser:
         Parameters
         ----------
         file_name: string
-        pools_addresses: list
+        pools_addresses: iterable
             optional
-            If no list is given uses one that was result of last get_addresses function
+            If nothing is given uses list that was result of last get_addresses function.
+            Any iterable (e.g. generator over Mongo cursor) is written item by item.
 
         Returns None
         """
@@ -99,21 +178,45 @@ class PoolAddressParser:
         if pools_addresses is None:
             pools_addresses = self.addresses
 
-        with open(file_name, 'w') as fout:
-            json.dump(pools_addresses, fout, indent=2)
+        write_json(file_name, pools_addresses)
+        return
+
+    def write_to_jsonl(self, file_name, pools_addresses = None):
+        """
+
+        Writes pools_addresses to JSON Lines file, one address per line
+
+        Parameters
+        ----------
+        file_name: string
+        pools_addresses: iterable
+            optional
+            If nothing is given uses list that was result of last get_addresses function.
+            Any iterable (e.g. generator over Mongo cursor) is written item by item.
+
+        Returns None
+        """
+
+        if pools_addresses is None:
+            pools_addresses = self.addresses
 
+        write_jsonl(file_name, pools_addresses)
         return
-    
-    def write_to_csv(self, file_name, pools_addresses = None):
+
+    def write_to_csv(self, file_name, pools_addresses = None, columns = None):
         """
         Writes pools_addresses to csv file
 
         Parameters
         ----------
         file_name: string
-        pools_addresses: list
+        pools_addresses: iterable
             optional
-            If no list is given uses one that was result of last get_addresses function
+            If nothing is given uses list that was result of last get_addresses function
+        columns: list
+            optional
+            (dotted) columns to write, e.g. address_columns. Defaults to fields of the first address.
+            Addresses are written row by row, so any iterable is written with constant memory.
 
         Returns None
         -------
@@ -122,21 +225,20 @@ class PoolAddressParser:
         if pools_addresses is None:
             pools_addresses = self.addresses
 
-        df = pd.json_normalize(pools_addresses)
-
-        df.to_csv(file_name)
+        write_csv(file_name, pools_addresses, columns)
         return
 
     def write_to_xml(self, file_name, pools_addresses = None):
         """
-        Writes pools_addresses to csv file
+        Writes pools_addresses to xml file
 
         Parameters
         ----------
         file_name: string
-        pools_addresses: list
+        pools_addresses: iterable
             optional
-            If no list is given uses one that was result of last get_addresses function
+            If nothing is given uses list that was result of last get_addresses function.
+            Any iterable (e.g. generator over Mongo cursor) is written item by item.
 
         Returns None
         -------
@@ -145,25 +247,20 @@ class PoolAddressParser:
         if pools_addresses is None:
             pools_addresses = self.addresses
 
-        xml = dicttoxml.dicttoxml(pools_addresses, attr_type=False)
-
-        dom = parseString(xml)
-
-        with open(file_name, 'w') as fout:
-            fout.write(dom.toprettyxml())
+        write_xml(file_name, pools_addresses)
         return
-        
-    
+
     def write_to_txt(self, file_name, pools_addresses = None):
         """
-        Writes pools_addresses to csv file
+        Writes formatted addresses of pools_addresses to txt file
 
         Parameters
         ----------
         file_name: string
-        pools_addresses: list
+        pools_addresses: iterable
             optional
-            If no list is given uses one that was result of last get_addresses function
+            If nothing is given uses list that was result of last get_addresses function.
+            Any iterable (e.g. generator over Mongo cursor) is written item by item.
 
         Returns None
         -------
@@ -172,9 +269,5 @@ class PoolAddressParser:
         if pools_addresses is None:
             pools_addresses = self.addresses
 
-        formattedAddress = [p["address"]["formattedAddress"] for p in pools_addresses]
-
-        with open(file_name, 'w') as fout:
-            fout.write('\n'.join(formattedAddress))
-
+        write_txt(file_name, pools_addresses)
         return
@@ -0,0 +1,175 @@
+import csv
+import json
+import re
+from xml.sax.saxutils import escape
+
+_base32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+
+def geohash(lat, long, precision=9):
+    """
+    Encodes lat long coordinates as geohash string of given length (amount of characters).
+    Points lying in the same cell share the geohash, cell of precision 9 is about 5 x 5 meters.
+    """
+    lat_range = [-90.0, 90.0]
+    long_range = [-180.0, 180.0]
+    code = []
+    bits = 0
+    value = 0
+    even = True
+    while len(code) < precision:
+        current, coordinate = (long_range, long) if even else (lat_range, lat)
+        middle = (current[0] + current[1]) / 2
+        value <<= 1
+        if coordinate >= middle:
+            value |= 1
+            current[0] = middle
+        else:
+            current[1] = middle
+        even = not even
+        bits += 1
+        if bits == 5:
+            code.append(_base32[value])
+            bits = 0
+            value = 0
+    return ''.join(code)
+
+# columns of csv files, Bing address fields flattened like pandas.json_normalize does
+address_columns = ['coordinates', 'address.addressLine', 'address.adminDistrict', 'address.adminDistrict2',
+                   'address.countryRegion', 'address.formattedAddress', 'address.locality', 'address.postalCode',
+                   'address.intersection.baseStreet', 'address.intersection.secondaryStreet1',
+                   'address.intersection.intersectionType', 'address.intersection.displayName']
+
+def write_jsonl(file_name, pools_addresses):
+    """
+    Writes addresses from any iterable (e.g. generator or Mongo cursor) to JSON Lines file, one object per line.
+    Returns amount of written addresses.
+    """
+    count = 0
+    with open(file_name, 'w') as fout:
+        for pool in pools_addresses:
+            fout.write(json.dumps(pool, default=str))
+            fout.write('\n')
+            count += 1
+    return count
+
+def write_json(file_name, pools_addresses):
+    """
+    Writes addresses from any iterable to JSON file item by item. Output is the same
+    as json.dump(list(pools_addresses), fout, indent=2). Returns amount of written addresses.
+    """
+    count = 0
+    with open(file_name, 'w') as fout:
+        fout.write('[')
+        for pool in pools_addresses:
+            fout.write(',\n  ' if count > 0 else '\n  ')
+            fout.write(json.dumps(pool, indent=2, default=str).replace('\n', '\n  '))
+            count += 1
+        fout.write('\n]' if count > 0 else ']')
+    return count
+
+def _flatten(obj, prefix='', row=None):
+    if row is None:
+        row = {}
+    for key, value in obj.items():
+        if isinstance(value, dict) and len(value) > 0:
+            _flatten(value, f"{prefix}{key}.", row)
+        else:
+            row[prefix + key] = value
+    return row
+
+def _columns(pool):
+    # dotted columns of the address in pandas.json_normalize order: plain top level fields first,
+    # then flattened nested objects, empty objects are left out
+    plain = [key for key, value in pool.items() if not isinstance(value, dict)]
+    nested = [column for key, value in pool.items() if isinstance(value, dict)
+              for column, field in _flatten(value, f"{key}.").items() if field != {}]
+    return plain + nested
+
+def write_csv(file_name, pools_addresses, columns=None):
+    """
+    Writes addresses from any iterable to CSV file row by row. Nested fields are flattened to
+    dotted columns (address.formattedAddress) and the first column is the row number, like
+    pandas.json_normalize(...).to_csv(...) does. Columns default to flattened fields of the first
+    address, fields missing in it are left out of all rows (pass columns, e.g. address_columns,
+    to choose them). Returns amount of written addresses.
+    """
+    count = 0
+    with open(file_name, 'w', newline='') as fout:
+        writer = csv.writer(fout, lineterminator='\n')
+        for pool in pools_addresses:
+            row = _flatten(pool)
+            if count == 0:
+                if columns is None:
+                    columns = _columns(pool)
+                writer.writerow([''] + list(columns))
+            writer.writerow([count] + [row.get(column) for column in columns])
+            count += 1
+        if count == 0:
+            writer.writerow([''] + list(columns or []))
+    return count
+
+# characters escaped by minidom besides &, < and >
+_xml_entities = { '"': '&quot;' }
+
+def _xml_tag(key):
+    key = str(key)
+    if key.isdigit():
+        key = 'n' + key
+    if re.match(r'^[A-Za-z_][\w.-]*$', key) and not key.lower().startswith('xml'):
+        return key, key
+    if re.match(r'^[A-Za-z_][\w.-]*$', key.replace(' ', '_')):
+        return key.replace(' ', '_'), key.replace(' ', '_')
+    return f'key name="{escape(key, _xml_entities)}"', 'key'
+
+def _write_xml(fout, tag, value, depth):
+    indent = '\t' * depth
+    open_tag, close_tag = tag
+    if isinstance(value, dict):
+        items = [(_xml_tag(key), item) for key, item in value.items()]
+    elif isinstance(value, (list, tuple)):
+        items = [(('item', 'item'), item) for item in value]
+    else:
+        if value is None or value == '':
+            fout.write(f"{indent}<{open_tag}/>\n")
+            return
+        text = str(value).lower() if isinstance(value, bool) else str(value)
+        fout.write(f"{indent}<{open_tag}>{escape(text, _xml_entities)}</{close_tag}>\n")
+        return
+    if len(items) == 0:
+        fout.write(f"{indent}<{open_tag}/>\n")
+        return
+    fout.write(f"{indent}<{open_tag}>\n")
+    for item_tag, item in items:
+        _write_xml(fout, item_tag, item, depth + 1)
+    fout.write(f"{indent}</{close_tag}>\n")
+
+def write_xml(file_name, pools_addresses):
+    """
+    Writes addresses from any iterable to XML file item by item. Output has the same layout
+    as pretty printed dicttoxml document (root element with item elements).
+    Returns amount of written addresses.
+    """
+    count = 0
+    with open(file_name, 'w') as fout:
+        fout.write('<?xml version="1.0" ?>\n')
+        for pool in pools_addresses:
+            if count == 0:
+                fout.write('<root>\n')
+            _write_xml(fout, ('item', 'item'), pool, 1)
+            count += 1
+        fout.write('</root>\n' if count > 0 else '<root/>\n')
+    return count
+
+def write_txt(file_name, pools_addresses):
+    """
+    Writes formatted addresses from any iterable to text file, one per line.
+    Returns amount of written addresses.
+    """
+    count = 0
+    with open(file_name, 'w') as fout:
+        for pool in pools_addresses:
+            if count > 0:
+                fout.write('\n')
+            fout.write(pool["address"]["formattedAddress"])
+            count += 1
+    return count
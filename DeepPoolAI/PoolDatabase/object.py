@@ -1,13 +1,175 @@
-from IPython.display import clear_output
 from bson.objectid import ObjectId
+from pymongo import monitoring
+import os
 import pymongo
+import threading
+import time
+
+
+class ConnectionPoolMetrics(monitoring.ConnectionPoolListener):
+
+    def __init__(self, max_pool_size=None):
+        """Connection Pool Metrics
+        Listener of connection pool events of MongoClient counting opened, closed and used connections
+        and measuring time of waiting for free connection.
+
+        Parameters
+        ----------
+        max_pool_size : integer
+            maximal size of the pool, reported in stats
+
+        Returns
+        -------
+        ConnectionPoolMetrics object
+        """
+        self.max_pool_size = max_pool_size
+        self.lock = threading.Lock()
+        self.created = 0
+        self.closed = 0
+        self.checked_out = 0
+        self.check_out_failed = 0
+        self.in_use = 0
+        self.max_in_use = 0
+        self.cleared = 0
+        self.wait_total = 0
+        self.wait_max = 0
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        with self.lock:
+            self.cleared += 1
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        with self.lock:
+            self.created += 1
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        with self.lock:
+            self.closed += 1
+
+    def connection_check_out_started(self, event):
+        pass
+
+    def connection_check_out_failed(self, event):
+        with self.lock:
+            self.check_out_failed += 1
+
+    def connection_checked_out(self, event):
+        duration = getattr(event, 'duration', None) or 0
+        with self.lock:
+            self.checked_out += 1
+            self.in_use += 1
+            self.max_in_use = max(self.max_in_use, self.in_use)
+            self.wait_total += duration
+            self.wait_max = max(self.wait_max, duration)
+
+    def connection_checked_in(self, event):
+        with self.lock:
+            self.in_use -= 1
+
+    def stats(self):
+        """
+        Returns dictionary with amount of open, created and closed connections, connections in use
+        (now and at most), check outs (successful and failed), pool clears and mean and maximal
+        time of check out in seconds.
+        """
+        with self.lock:
+            return {
+                'max_pool_size': self.max_pool_size,
+                'open': self.created - self.closed,
+                'created': self.created,
+                'closed': self.closed,
+                'in_use': self.in_use,
+                'max_in_use': self.max_in_use,
+                'checked_out': self.checked_out,
+                'check_out_failed': self.check_out_failed,
+                'cleared': self.cleared,
+                'wait_mean': self.wait_total / self.checked_out if self.checked_out else 0,
+                'wait_max': self.wait_max
+            }
+
 
 class PoolDatabase:
+    uri = "mongodb://localhost:27017/"
+    client_options = {
+        'maxPoolSize': 100,
+        'minPoolSize': 0,
+        'maxIdleTimeMS': 300000,
+        'connectTimeoutMS': 20000,
+        'serverSelectionTimeoutMS': 30000,
+        'waitQueueTimeoutMS': None,
+        'socketTimeoutMS': None
+    }
+    _clients = {}
+    _clients_pid = os.getpid()
+    _clients_lock = threading.Lock()
 
-    def __init__(self, init_app=True):
-        self.client = pymongo.MongoClient("mongodb://localhost:27017/")
+    def __init__(self, init_app=True, uri=None, **options):
+        """
+        Connects to the database. All instances with the same uri and options share one MongoClient
+        (and its connection pool) in the process, see get_client.
+
+        Parameters
+        ----------
+        uri : string
+            MongoDB connection string, defaults to PoolDatabase.uri
+        options : dict
+            MongoClient options overriding PoolDatabase.client_options (e.g. maxPoolSize, waitQueueTimeoutMS)
+        """
+        self.client, self.metrics = PoolDatabase.get_client(uri, **options)
         self.db = self.client["pools"]
 
+    @classmethod
+    def configure(cls, uri=None, **options):
+        """
+        Changes default uri and MongoClient options (pool size, timeouts) of instances created later.
+        """
+        if uri is not None:
+            cls.uri = uri
+        cls.client_options = dict(cls.client_options, **options)
+
+    @classmethod
+    def _reset_clients(cls):
+        # clients of the parent process must not be used (nor closed) in forked child
+        cls._clients = {}
+        cls._clients_pid = os.getpid()
+        cls._clients_lock = threading.Lock()
+
+    @classmethod
+    def get_client(cls, uri=None, **options):
+        """
+        Returns (MongoClient, ConnectionPoolMetrics) tuple shared by the whole process for the uri and options
+        (merged with defaults). Child process created by fork gets own clients.
+        """
+        uri = uri if uri is not None else cls.uri
+        options = dict(cls.client_options, **options)
+        key = (uri, tuple(sorted(options.items())))
+        if cls._clients_pid != os.getpid():
+            cls._reset_clients()
+        with cls._clients_lock:
+            entry = cls._clients.get(key)
+            if entry is None:
+                metrics = ConnectionPoolMetrics(options.get('maxPoolSize'))
+                entry = cls._clients[key] = (pymongo.MongoClient(uri, event_listeners=[metrics], **options), metrics)
+            return entry
+
+    def pool_stats(self):
+        """
+        Returns metrics of connection pool of the client (see ConnectionPoolMetrics.stats).
+        """
+        return self.metrics.stats()
+
     def map_to_geo(self, points):
         return list(map(lambda p: { 'type': 'Point', 'coordinates': p }, points))
 
@@ -25,14 +187,227 @@ class PoolDatabase:
         obj = self.db['batches'].find_one(ObjectId(_id))
         return { k: obj.get(k) if k not in geo_fields else self.map_from_geo(obj.get(k)) for k in obj.keys() }
 
+    def update_batch(self, batch_id, fields=None, inc=None):
+        """
+        Updates only given fields of the batch ($set for fields, $inc for inc).
+        """
+        update = {}
+        if fields:
+            update['$set'] = fields
+        if inc:
+            update['$inc'] = inc
+        if update:
+            self.db['batches'].update_one({ '_id': ObjectId(batch_id) }, update)
+
     def summary_batches(self):
-        keys = ['width', 'height', 'zoomLevel', 'is_working', 'progress', 'todo', 'done', 'nodes', '_id', 'name', 'osm_done', 'pools_detected']
+        keys = ['width', 'height', 'zoomLevel', 'is_working', 'progress', 'todo', 'done', 'nodes', '_id', 'name', 'osm_done', 'osm_working', 'pools_detected']
         len_keys = ['todo', 'done']
         geo_keys = ['nodes']
         stream = self.db['batches'].find({})
         def map(obj):
-            return { k: len(obj.get(k)) if k in len_keys else (self.map_from_geo(obj.get(k)) if k in geo_keys else obj.get(k)) for k in obj.keys() if k in keys}
+            summary = { k: len(obj.get(k)) if k in len_keys else (self.map_from_geo(obj.get(k)) if k in geo_keys else obj.get(k)) for k in obj.keys() if k in keys}
+            if obj.get('tiles_total') is not None:
+                summary['done'] = obj.get('tiles_done')
+                summary['todo'] = obj.get('tiles_total') - obj.get('tiles_done')
+            return summary
         return [map(obj) for obj in stream]
+
+    def set_tiles(self, batch_id, coords, done=False, start=0, chunk_size=10000):
+        """
+        Stores tiles (photo centers) of the batch as separate documents with consecutive indexes.
+        """
+        batch_id = ObjectId(batch_id)
+        self.db['tiles'].create_index([('batch', pymongo.ASCENDING), ('done', pymongo.ASCENDING), ('index', pymongo.ASCENDING)])
+        self.db['tiles'].create_index([('batch', pymongo.ASCENDING), ('done', pymongo.ASCENDING), ('lease_expires', pymongo.ASCENDING)])
+        for chunk in range(0, len(coords), chunk_size):
+            points = self.map_to_geo([[float(c[0]), float(c[1])] for c in coords[chunk:chunk + chunk_size]])
+            self.db['tiles'].insert_many([
+                { 'batch': batch_id, 'index': start + chunk + i, 'coordinates': point, 'done': done }
+                for i, point in enumerate(points)
+            ], ordered=False)
+
+    def get_tiles(self, batch_id, done=False):
+        """
+        Returns list of (index, [lat, lng]) tuples of tiles of the batch sorted by index.
+        """
+        stream = self.db['tiles'].find({ 'batch': ObjectId(batch_id), 'done': done }, { 'index': 1, 'coordinates': 1 })
+        return [(t['index'], t['coordinates']['coordinates']) for t in stream.sort('index', pymongo.ASCENDING)]
+
+    @staticmethod
+    def _owner(machine_id):
+        # filter of tiles leased by the machine, { 'lease_owner': None } alone would match all unleased tiles
+        return { '$ne': None, '$eq': machine_id }
+
+    def mark_tiles_done(self, batch_id, indices, skipped=False, machine_id=None):
+        """
+        Marks tiles as done and increments tiles_done counter of the batch. Returns amount of changed tiles.
+        Tiles marked with skipped=True (not worth fetching) are flagged and counted in tiles_skipped too.
+        If machine_id is given, only tiles still leased by the machine are marked.
+        """
+        if len(indices) == 0:
+            return 0
+        batch_id = ObjectId(batch_id)
+        fields = { 'done': True, 'skipped': True } if skipped else { 'done': True }
+        query = { 'batch': batch_id, 'done': False, 'index': { '$in': list(indices) } }
+        if machine_id is not None:
+            query['lease_owner'] = self._owner(machine_id)
+        result = self.db['tiles'].update_many(query, { '$set': fields,
+                                                       '$unset': { 'lease_owner': '', 'lease_expires': '', 'lease_id': '' } })
+        inc = { 'tiles_done': result.modified_count }
+        if skipped:
+            inc['tiles_skipped'] = result.modified_count
+        self.update_batch(batch_id, inc=inc)
+        return result.modified_count
+
+    def leased_tiles(self, batch_id, machine_id, indices):
+        """
+        Returns sorted list of those of given unfinished tiles which are still leased by the machine
+        (their lease was not taken over by other worker after expiring).
+        """
+        if len(indices) == 0:
+            return []
+        stream = self.db['tiles'].find({ 'batch': ObjectId(batch_id), 'done': False, 'index': { '$in': list(indices) },
+                                         'lease_owner': self._owner(machine_id) }, { 'index': 1 })
+        return sorted(t['index'] for t in stream)
+
+    def count_free_tiles(self, batch_id):
+        """
+        Returns amount of unfinished tiles of the batch which are not leased or whose lease expired.
+        """
+        return self.db['tiles'].count_documents({ 'batch': ObjectId(batch_id), 'done': False,
+                                                  '$or': [{ 'lease_expires': None }, { 'lease_expires': { '$lt': time.time() } }] })
+
+    def lease_tiles(self, batch_id, machine_id, count, lease_seconds=300, after=-1):
+        """
+        Claims up to count unfinished tiles with index greater than after, which are not leased or whose
+        lease expired. Candidates are found with one query and claimed with one conditional update, tiles
+        taken by other worker in the meantime are left to it.
+        Returns list of (index, [lat, lng]) tuples of claimed tiles sorted by index.
+        """
+        if machine_id is None:
+            raise Exception('Leasing tiles requires machine id')
+        batch_id = ObjectId(batch_id)
+        while True:
+            now = time.time()
+            free = { 'batch': batch_id, 'done': False, 'index': { '$gt': after },
+                     '$or': [{ 'lease_expires': None }, { 'lease_expires': { '$lt': now } }] }
+            candidates = [t['index'] for t in self.db['tiles'].find(free, { 'index': 1 })
+                          .sort('index', pymongo.ASCENDING).limit(count)]
+            if len(candidates) == 0:
+                return []
+            lease_id = ObjectId()
+            free['index'] = { '$in': candidates }
+            self.db['tiles'].update_many(free, { '$set': { 'lease_owner': machine_id, 'lease_expires': now + lease_seconds,
+                                                           'lease_id': lease_id } })
+            stream = self.db['tiles'].find({ 'batch': batch_id, 'done': False, 'index': { '$in': candidates }, 'lease_id': lease_id },
+                                           { 'index': 1, 'coordinates': 1 })
+            tiles = sorted((t['index'], t['coordinates']['coordinates']) for t in stream)
+            if len(tiles) > 0:
+                return tiles
+
+    def release_tiles(self, batch_id, machine_id, indices):
+        """
+        Releases given unfinished tiles leased by the machine, so other workers can take them immediately.
+        """
+        if len(indices) == 0:
+            return
+        self.db['tiles'].update_many({ 'batch': ObjectId(batch_id), 'done': False, 'index': { '$in': list(indices) },
+                                       'lease_owner': self._owner(machine_id) },
+                                     { '$unset': { 'lease_owner': '', 'lease_expires': '', 'lease_id': '' } })
+
+    def get_batch_fields(self, batch_id, fields):
+        """
+        Returns dictionary with only given fields of the batch.
+        """
+        return self.db['batches'].find_one({ '_id': ObjectId(batch_id) }, { field: 1 for field in fields })
+
+    def renew_leases(self, batch_id, machine_id, lease_seconds=300):
+        """
+        Heartbeat of the worker. Extends all its leases of the batch.
+        """
+        batch_id = ObjectId(batch_id)
+        now = time.time()
+        self.db['tiles'].update_many({ 'batch': batch_id, 'done': False, 'lease_owner': self._owner(machine_id) },
+                                     { '$set': { 'lease_expires': now + lease_seconds } })
+        self.update_batch(batch_id, { 'heartbeats.' + str(machine_id): now })
+
+    def release_leases(self, machine_id, batch_id=None):
+        """
+        Releases unfinished tiles leased by the machine, so other workers can take them immediately.
+        """
+        query = { 'done': False, 'lease_owner': self._owner(machine_id) }
+        if batch_id is not None:
+            query['batch'] = ObjectId(batch_id)
+        self.db['tiles'].update_many(query, { '$unset': { 'lease_owner': '', 'lease_expires': '', 'lease_id': '' } })
+
+    def lease_summary(self, batch_id):
+        """
+        Returns amounts of all, done, leased and free tiles of the batch and amounts of tiles leased by every machine.
+        """
+        now = time.time()
+        groups = self.db['tiles'].aggregate([
+            { '$match': { 'batch': ObjectId(batch_id) } },
+            { '$group': {
+                '_id': { 'done': '$done', 'owner': { '$cond': [{ '$gte': ['$lease_expires', now] }, '$lease_owner', None] } },
+                'count': { '$sum': 1 }
+            } }
+        ])
+        summary = { 'total': 0, 'done': 0, 'leased': 0, 'free': 0, 'machines': {} }
+        for group in groups:
+            summary['total'] += group['count']
+            if group['_id']['done']:
+                summary['done'] += group['count']
+            elif group['_id'].get('owner') is None:
+                summary['free'] += group['count']
+            else:
+                summary['leased'] += group['count']
+                owner = str(group['_id']['owner'])
+                summary['machines'][owner] = summary['machines'].get(owner, 0) + group['count']
+        return summary
+
+    def start_work(self, batch_id, machine_id, fields={}):
+        """
+        Registers the machine as one of workers of the batch.
+        """
+        self.db['batches'].update_one({ '_id': ObjectId(batch_id) }, {
+            '$addToSet': { 'working_machines': machine_id },
+            '$set': dict(fields, is_working=True, working_machine=machine_id, **{ 'heartbeats.' + str(machine_id): time.time() })
+        })
+
+    def finish_work(self, batch_id, machine_id, lease_seconds=300):
+        """
+        Releases leases of the machine and removes it (and workers without heartbeat) from the batch.
+        Batch stops working when no workers are left.
+        """
+        batch_id = ObjectId(batch_id)
+        self.release_leases(machine_id, batch_id)
+        batch = self.db['batches'].find_one({ '_id': batch_id }, { 'working_machines': 1, 'heartbeats': 1 })
+        heartbeats = batch.get('heartbeats') or {}
+        stale = [machine_id] + [m for m in batch.get('working_machines') or []
+                                if m != machine_id and heartbeats.get(str(m), 0) < time.time() - lease_seconds]
+        self.db['batches'].update_one({ '_id': batch_id }, {
+            '$pull': { 'working_machines': { '$in': stale } },
+            '$unset': { 'heartbeats.' + str(m): '' for m in stale }
+        })
+        self.db['batches'].update_one({ '_id': batch_id, 'working_machines': { '$size': 0 } }, { '$set': { 'is_working': False } })
+
+    def migrate_batch_tiles(self, batch_id):
+        """
+        Moves todo and done arrays of batches created by older versions to the tiles collection.
+        """
+        batch_id = ObjectId(batch_id)
+        obj = self.db['batches'].find_one({ '_id': batch_id, 'todo': { '$exists': True } }, { 'todo': 1, 'done': 1 })
+        if obj is None:
+            return
+        done = self.map_from_geo(obj.get('done') or [])
+        todo = self.map_from_geo(obj.get('todo') or [])
+        self.db['tiles'].delete_many({ 'batch': batch_id })
+        self.set_tiles(batch_id, done, done=True)
+        self.set_tiles(batch_id, todo, start=len(done))
+        self.db['batches'].update_one({ '_id': batch_id }, {
+            '$set': { 'tiles_total': len(done) + len(todo), 'tiles_done': len(done) },
+            '$unset': { 'todo': '', 'done': '' }
+        })
     
     def set_point(self, point):
         point['coordinates'] = self.map_to_geo([point['coordinates']])[0]
@@ -45,13 +420,99 @@ class PoolDatabase:
         batch_id = ObjectId(batch_id)
         return list(self.db['pools'].find({ 'batch': batch_id }))
 
+    def iter_pool_coordinates(self, batch_id):
+        """
+        Yields [lat, lng] coordinates of pools of the batch, only coordinates field is read.
+        """
+        stream = self.db['pools'].find({ 'batch': ObjectId(batch_id) }, { 'coordinates': 1, '_id': 0 })
+        for pool in stream:
+            yield pool['coordinates']['coordinates']
+
+    def set_pool_addresses(self, addresses):
+        """
+        Sets addresses of many pools at once. Addresses is a list of (pool_id, address) tuples.
+        """
+        if len(addresses) == 0:
+            return
+        self.db['pools'].bulk_write([pymongo.UpdateOne({ '_id': pool_id }, { '$set': { 'address': address } })
+                                     for pool_id, address in addresses], ordered=False)
+
+    def iter_pools_without_osm(self, batch_id, levels, chunk_size=1000):
+        """
+        Yields chunks (lists) of pools of the batch, which miss osm relation of any of the levels (osm.lvl_<level>).
+        Pools have only _id, coordinates and osm fields. Chunks are read by _id ranges, so pools updated
+        in the meantime are not returned again and pools added in the meantime are returned too.
+        """
+        batch_id = ObjectId(batch_id)
+        self.db['pools'].create_index([('batch', pymongo.ASCENDING), ('_id', pymongo.ASCENDING)])
+        query = { 'batch': batch_id, '$or': [{ 'osm.lvl_' + str(level): { '$exists': False } } for level in levels] }
+        last = None
+        while True:
+            if last is not None:
+                query['_id'] = { '$gt': last }
+            chunk = list(self.db['pools'].find(query, { 'coordinates': 1, 'osm': 1 })
+                         .sort('_id', pymongo.ASCENDING).limit(chunk_size))
+            if len(chunk) == 0:
+                return
+            last = chunk[-1]['_id']
+            yield chunk
+
+    def set_pools_osm(self, assignments):
+        """
+        Sets osm relations of many pools at once. Assignments is a list of (pool_id, osm) tuples.
+        """
+        if len(assignments) == 0:
+            return
+        self.db['pools'].bulk_write([pymongo.UpdateOne({ '_id': pool_id }, { '$set': { 'osm': osm } })
+                                     for pool_id, osm in assignments], ordered=False)
+
+    def claim_coarse_scan(self, batch_id, levels):
+        """
+        Sets adaptive_zoom of the batch to levels, if its coarse scan was not claimed yet.
+        Returns False if other worker already claimed the scan.
+        """
+        result = self.db['batches'].update_one({ '_id': ObjectId(batch_id), 'adaptive_zoom': None },
+                                               { '$set': { 'adaptive_zoom': levels } })
+        return result.modified_count == 1
+
+    def start_osm(self, batch_id, machine_id):
+        """
+        Marks the batch as having osm assignment in progress (osm_working), independently of detection.
+        Returns False if assignment of the batch is already running.
+        """
+        result = self.db['batches'].update_one({ '_id': ObjectId(batch_id), 'osm_working': { '$ne': True } },
+                                               { '$set': { 'osm_working': True, 'osm_machine': machine_id } })
+        return result.modified_count == 1
+
+    def finish_osm(self, batch_id, levels):
+        """
+        Ends osm assignment of the batch. It is done (osm_done), if detection is not running and all pools have
+        relations of all levels. Returns value of osm_done.
+        """
+        batch_id = ObjectId(batch_id)
+        batch = self.db['batches'].find_one({ '_id': batch_id }, { 'is_working': 1 })
+        missing = self.db['pools'].find_one({ 'batch': batch_id, '$or': [{ 'osm.lvl_' + str(level): { '$exists': False } }
+                                                                          for level in levels] }, { '_id': 1 })
+        done = not batch.get('is_working') and missing is None
+        self.update_batch(batch_id, { 'osm_working': False, 'osm_done': done })
+        return done
+
     def close_tasks_for_machine(self, machine_id):
-        self.db['batches'].update_many({ 'working_machine': machine_id }, { '$set': { 'is_working': False } })
+        self.release_leases(machine_id)
+        self.db['batches'].update_many({ 'osm_working': True, 'osm_machine': machine_id }, { '$set': { 'osm_working': False } })
+        self.db['batches'].update_many({ 'working_machines': machine_id }, {
+            '$pull': { 'working_machines': machine_id },
+            '$unset': { 'heartbeats.' + str(machine_id): '' }
+        })
+        self.db['batches'].update_many({ 'working_machine': machine_id,
+                                         '$or': [{ 'working_machines': None }, { 'working_machines': { '$size': 0 } }] },
+                                       { '$set': { 'is_working': False } })
 
     def delete_batch(self, batch_id):
         if not self.get_batch(batch_id).get('is_working'):
             batch_id = ObjectId(batch_id)
             self.db['pools'].delete_many({ 'batch': batch_id })
+            self.db['tiles'].delete_many({ 'batch': batch_id })
             self.db['batches'].delete_one({ '_id': batch_id })
         else:
             raise Exception('Cannot remove working batch')
@@ -61,3 +522,7 @@ class PoolDatabase:
         queries = [{ path: polygon_id } for path in paths]
         print(queries)
         return list(self.db['pools'].find({ '$or': queries }))
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=PoolDatabase._reset_clients)
@@ -1,7 +1,13 @@
 import cv2 as cv
 import numpy as np
+import os
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import resource_tracker, shared_memory
 from PIL import Image
 from .utils import *
+from .utils import _detect_shared
 
 
 class PoolDetector:
@@ -12,66 +18,53 @@ class PoolDetector:
         self.boxes = None
         self.mean_colors = []
 
-    def get_pools(self):
-        img = np.array(self.photo)
-        ref_colors = [{
-            'hsv': np.array([85.55029586, 67.23076923, 167.73964497]),
-            'radius': np.array([30, 30, 30])
-        },
-            {
-                'hsv': np.array([95.473562474846, 73.45679919145016, 84.95061728395059]),
-                'radius': np.array([10, 10, 10])
-            },
-            {
-                'hsv': np.array([90.54043979824111, 63.88068312831349, 103.23456790123457]),
-                'radius': np.array([15, 10, 10])
-            },
-            {
-                'hsv': np.array([[92.83158052601456, 93.71934600803863, 214.28395061728398]]),
-                'radius': np.array([15, 20, 20])
-            }]
-        img_hsv = cv.cvtColor(img, cv.COLOR_RGB2HSV)
-        mask = np.zeros(img.shape[0:2])
-        for ref in ref_colors:
-            mask += cv.inRange(img_hsv, ref['hsv'] - ref['radius'], ref['hsv'] + ref['radius'])
-        mask = np.array(mask > 0, dtype=np.uint8) * 255
-        contours, _ = cv.findContours(mask, cv.RETR_TREE, cv.CHAIN_APPROX_SIMPLE)
-        boxes = []
-        for cont in contours:
-            box = [0, 0, 0, 0]
-            x = cont[:, 0, 0]
-            y = cont[:, 0, 1]
-            box = [np.min(x), np.max(x), np.min(y), np.max(y)]
-            if box[1] - box[0] > 5 and box[3] - box[2] > 5:
-                boxes.append(box)
-
-        self.boxes = boxes
-        boxes = np.array(boxes)
-        median_color = []
-
-        # amount of pixels from center
-        pixels_from_center = 3
-
-        if len(boxes) > 0 :
-            pixel_coords = np.concatenate((boxes[:, :2].mean(axis=1).reshape(boxes.shape[0], 1),
-                                            boxes[:, 2:].mean(axis=1).reshape(boxes.shape[0], 1)), axis=1).tolist()
-            self.pixel_coords = pixel_coords
-            pixel_coords_array = np.array(pixel_coords)
-            for pixel_coord in pixel_coords_array:
-
-                x_start = pixel_coord[0] - pixels_from_center
-                x_end   = pixel_coord[0] + pixels_from_center
-                y_start = pixel_coord[1] - pixels_from_center
-                y_end   = pixel_coord[1] + pixels_from_center
-
-                color_grid = np.meshgrid(np.arange(x_start, x_end+1), np.arange(y_start, y_end+1), indexing='ij')
-
-                mean_col = img[color_grid[1].astype("int32"), color_grid[0].astype("int32")].mean(axis = 1).mean(axis = 0)
-
-                self.mean_colors.append(mean_col)
-
+    def get_pools(self, detector=None, blob_method='contours'):
+        """
+        Finds pools on the photo with blob_method (see find_pools). If detector (BatchDetector)
+        is given, its buffered path and its blob_method are used.
+        """
+        if detector is not None:
+            self.boxes, self.pixel_coords, self.mean_colors = detector.find([self.photo])[0]
+            return
+        img = np.asarray(self.photo)
+        self.boxes, self.pixel_coords, self.mean_colors = find_pools(img, blob_method)
         return
 
+    @staticmethod
+    def from_result(result, photo=None):
+        """
+        Creates PoolDetector with pools found by DetectorPool worker.
+        """
+        boxes, pixel_coords, mean_colors = result
+        pd = PoolDetector(photo)
+        pd.boxes = boxes.tolist()
+        pd.pixel_coords = None if pixel_coords is None else pixel_coords.tolist()
+        pd.mean_colors = list(mean_colors)
+        return pd
+
+    @staticmethod
+    def detect_many(images, processes=None, pool=None):
+        """ Detect Many
+        Finds pools on many images using all cores.
+
+        Parameters
+        ----------
+        images : iterable
+            PIL images or RGB numpy arrays
+        processes : integer
+            amount of worker processes, defaults to amount of cores
+        pool : DetectorPool
+            optional running pool of workers to use
+
+        Returns
+        -------
+        List of PoolDetector objects with found pools, in order of images
+        """
+        if pool is not None:
+            return list(pool.imap(images))
+        with DetectorPool(processes) as pool:
+            return list(pool.imap(images))
+
     def print_boxes(self):
         img = np.array(self.photo)
         boxes = self.boxes
@@ -79,3 +72,201 @@ class PoolDetector:
         for box in boxes:
             cv.rectangle(img_boxes, (box[0], box[2]), (box[1], box[3]), (0, 255, 0), 2)
         return cv2pillow(img_boxes)
+
+
+class BatchDetector:
+
+    def __init__(self, blob_method='contours'):
+        """Batch Detector
+        High throughput pool detection on stacks of same size tiles. Reference colors are
+        tested with one precomputed HSV lookup table (ref_lut) instead of four cv.inRange
+        calls and uint8 buffers are reused between calls. Finds the same pools as find_pools.
+
+        Parameters
+        ----------
+        blob_method : string
+            'contours' - boxes of all contours like find_pools,
+            'components' - boxes of connected components (blobs_from_mask), faster on tiles
+            with many candidates, but holes inside pools are not reported as separate boxes
+
+        Returns
+        -------
+        BatchDetector object
+        """
+        if blob_method not in blob_methods:
+            raise Exception(f'Unknown blob method {blob_method}')
+        self.blob_method = blob_method
+        self.shape = None
+        self.stack = None
+        self.hsv = None
+        self.bits = None
+        self.mask = None
+        self.labels = None
+
+    def _allocate(self, shape):
+        if self.shape == shape:
+            return
+        n, height, width = shape[:3]
+        self.shape = shape
+        self.stack = np.empty((n, height, width, 3), dtype=np.uint8)
+        self.hsv = np.empty((n * height, width, 3), dtype=np.uint8)
+        self.bits = np.empty((n * height, width, 3), dtype=np.uint8)
+        self.mask = np.empty((n * height, width), dtype=np.uint8)
+        self.labels = np.empty((n * height, width), dtype=np.int32)
+
+    def find(self, images):
+        """ Find
+        Finds pools on every image of the stack.
+
+        Parameters
+        ----------
+        images : numpy.ndarray or list
+            uint8 RGB array of shape (n, height, width, 3) or list of same size PIL images / RGB arrays
+
+        Returns
+        -------
+        List of (boxes, pixel_coords, mean_colors) tuples like find_pools returns, in order of images
+        """
+        if isinstance(images, np.ndarray) and images.ndim == 4 and images.dtype == np.uint8:
+            stack = np.ascontiguousarray(images)
+            self._allocate(stack.shape)
+        else:
+            images = [np.asarray(image) for image in images]
+            self._allocate((len(images),) + images[0].shape)
+            stack = self.stack
+            for index, image in enumerate(images):
+                stack[index] = image
+        n, height, width = stack.shape[:3]
+        cv.cvtColor(stack.reshape(n * height, width, 3), cv.COLOR_RGB2HSV, dst=self.hsv)
+        pool_mask(self.hsv, self.bits, self.mask)
+        results = []
+        for index in range(n):
+            rows = slice(index * height, (index + 1) * height)
+            if self.blob_method == 'components':
+                boxes = blobs_from_mask(self.mask[rows], self.labels[rows])
+            else:
+                boxes = boxes_from_mask(self.mask[rows])
+            pixel_coords, mean_colors = describe_boxes(stack[index], boxes)
+            results.append((boxes, pixel_coords, mean_colors))
+        return results
+
+    def detect(self, images):
+        """
+        Returns PoolDetector objects with pools found on images (see find).
+        """
+        detectors = []
+        for index, (boxes, pixel_coords, mean_colors) in enumerate(self.find(images)):
+            pd = PoolDetector(images[index])
+            pd.boxes, pd.pixel_coords, pd.mean_colors = boxes, pixel_coords, mean_colors
+            detectors.append(pd)
+        return detectors
+
+
+class DetectorPool:
+
+    def __init__(self, processes=None, blob_method='contours'):
+        """Detector Pool
+        Pool of worker processes running pool detection. Decoded images are copied
+        to reusable shared memory blocks, workers read them without pickling and
+        send back only boxes, centers and mean colors.
+
+        Parameters
+        ----------
+        processes : integer
+            amount of worker processes, defaults to amount of cores
+        blob_method : string
+            'contours' or 'components', see find_pools
+
+        Returns
+        -------
+        DetectorPool object
+        """
+        if blob_method not in blob_methods:
+            raise Exception(f'Unknown blob method {blob_method}')
+        self.processes = processes or os.cpu_count()
+        self.blob_method = blob_method
+        # workers must share tracker of shared memory with this process,
+        # otherwise they would remove blocks when they exit
+        resource_tracker.ensure_running()
+        self.executor = ProcessPoolExecutor(self.processes)
+        self.blocks = []
+        self.free = {}
+        self.lock = threading.Lock()
+        # start workers now, before caller starts other threads
+        self.executor.submit(int).result()
+
+    def _take_block(self, size):
+        with self.lock:
+            blocks = self.free.get(size)
+            if blocks:
+                return blocks.pop()
+        block = shared_memory.SharedMemory(create=True, size=size)
+        with self.lock:
+            self.blocks.append(block)
+        return block
+
+    def _give_back(self, block, size):
+        with self.lock:
+            self.free.setdefault(size, []).append(block)
+
+    def submit(self, photo):
+        """ Submit
+        Schedules detection of pools on the photo.
+
+        Parameters
+        ----------
+        photo : PIL image or numpy array
+            RGB image
+
+        Returns
+        -------
+        concurrent.futures.Future resolved with PoolDetector object
+        """
+        img = np.asarray(photo)
+        size = max(1, img.nbytes)
+        block = self._take_block(size)
+        np.ndarray(img.shape, dtype=img.dtype, buffer=block.buf)[...] = img
+        future = self.executor.submit(_detect_shared, block.name, img.shape, img.dtype.str, self.blob_method)
+        future.add_done_callback(lambda _: self._give_back(block, size))
+        return _DetectionFuture(future, photo)
+
+    def imap(self, images):
+        """
+        Yields PoolDetector objects for images in their order, keeping at most 2 * processes images in flight.
+        """
+        pending = deque()
+        for photo in images:
+            pending.append(self.submit(photo))
+            if len(pending) >= 2 * self.processes:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+    def close(self):
+        """
+        Stops workers and frees shared memory.
+        """
+        self.executor.shutdown()
+        with self.lock:
+            blocks = self.blocks
+            self.blocks = []
+            self.free = {}
+        for block in blocks:
+            block.close()
+            block.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class _DetectionFuture:
+
+    def __init__(self, future, photo):
+        self.future = future
+        self.photo = photo
+
+    def result(self, timeout=None):
+        return PoolDetector.from_result(self.future.result(timeout), self.photo)
@@ -1,7 +1,163 @@
 import cv2 as cv
 import numpy as np
 from PIL import Image
+from multiprocessing import shared_memory
 
 def cv2pillow(img):
-    return Image.fromarray(np.uint8(img))
+    return Image.fromarray(np.asarray(img, dtype=np.uint8))
 
+def decode_photo(data, out=None):
+    """
+    Decodes encoded (jpeg, png) image bytes straight to RGB numpy array of shape (height, width, 3).
+    If out array of the same shape is given, pixels are written into it.
+    """
+    img = cv.imdecode(np.frombuffer(data, dtype=np.uint8), cv.IMREAD_COLOR)
+    if img is None:
+        raise Exception('Cannot decode photo')
+    if out is None or out.shape != img.shape:
+        out = img
+    return cv.cvtColor(img, cv.COLOR_BGR2RGB, dst=out)
+
+# reference colors of pools in HSV with allowed radius
+ref_colors = [{
+    'hsv': np.array([85.55029586, 67.23076923, 167.73964497]),
+    'radius': np.array([30, 30, 30])
+},
+    {
+        'hsv': np.array([95.473562474846, 73.45679919145016, 84.95061728395059]),
+        'radius': np.array([10, 10, 10])
+    },
+    {
+        'hsv': np.array([90.54043979824111, 63.88068312831349, 103.23456790123457]),
+        'radius': np.array([15, 10, 10])
+    },
+    {
+        'hsv': np.array([[92.83158052601456, 93.71934600803863, 214.28395061728398]]),
+        'radius': np.array([15, 20, 20])
+    }]
+
+def _ref_lut():
+    """
+    Builds lookup table of shape (256, 1, 3) for cv.LUT. Bit k of entry [v, 0, c] is set
+    if value v of channel c is within range of k-th reference color. Bounds are rounded
+    to integers like cv.inRange does for uint8 images.
+    """
+    lut = np.zeros((256, 1, 3), dtype=np.uint8)
+    values = np.arange(256)
+    for bit, ref in enumerate(ref_colors):
+        lower = np.clip(np.rint(np.ravel(ref['hsv'] - ref['radius'])), 0, 255)
+        upper = np.clip(np.rint(np.ravel(ref['hsv'] + ref['radius'])), 0, 255)
+        for channel in range(3):
+            inside = (values >= lower[channel]) & (values <= upper[channel])
+            lut[inside, 0, channel] |= 1 << bit
+    return lut
+
+ref_lut = _ref_lut()
+
+# ways of turning pool mask into boxes, see boxes_from_mask and blobs_from_mask
+blob_methods = ('contours', 'components')
+
+# amount of pixels from center used for mean colors
+pixels_from_center = 3
+
+def pool_mask(img_hsv, bits=None, mask=None):
+    """
+    Computes mask (255 - pool colored pixel, 0 - other) of HSV image with ref_lut.
+    Same as sum of cv.inRange masks of all reference colors. If given, bits
+    (same shape as img_hsv) and mask (img_hsv.shape[:2]) uint8 buffers are reused.
+    """
+    bits = cv.LUT(img_hsv, ref_lut, dst=bits)
+    mask = np.bitwise_and(bits[..., 0], bits[..., 1], out=mask)
+    np.bitwise_and(mask, bits[..., 2], out=mask)
+    return cv.compare(mask, 0, cv.CMP_GT, dst=mask)
+
+def boxes_from_mask(mask):
+    """
+    Returns [x_min, x_max, y_min, y_max] boxes of contours of the mask bigger than 5 pixels in both directions.
+    """
+    contours, _ = cv.findContours(mask, cv.RETR_TREE, cv.CHAIN_APPROX_SIMPLE)
+    boxes = []
+    for cont in contours:
+        x, y, w, h = cv.boundingRect(cont)
+        if w - 1 > 5 and h - 1 > 5:
+            boxes.append([x, x + w - 1, y, y + h - 1])
+    return boxes
+
+def blobs_from_mask(mask, labels=None):
+    """
+    Returns [x_min, x_max, y_min, y_max] boxes of 8-connected blobs of the mask bigger than
+    5 pixels in both directions, found with one cv.connectedComponentsWithStats call.
+    Unlike boxes_from_mask, no boxes are returned for holes inside blobs (inner contours
+    of RETR_TREE), and boxes are ordered by top-left pixel of blobs.
+    If given, labels int32 buffer of mask shape is reused.
+    """
+    _, _, stats, _ = cv.connectedComponentsWithStats(mask, labels, connectivity=8, ltype=cv.CV_32S)
+    stats = stats[1:]
+    x = stats[:, cv.CC_STAT_LEFT]
+    y = stats[:, cv.CC_STAT_TOP]
+    x_max = x + stats[:, cv.CC_STAT_WIDTH] - 1
+    y_max = y + stats[:, cv.CC_STAT_HEIGHT] - 1
+    keep = (x_max - x > 5) & (y_max - y > 5)
+    return np.stack((x, x_max, y, y_max), axis=1)[keep].tolist()
+
+def describe_boxes(img, boxes):
+    """
+    Returns (pixel_coords, mean_colors) of boxes found on RGB image,
+    pixel_coords is None if there are no boxes. Squares around centers
+    of all boxes are gathered and averaged at once.
+    """
+    if len(boxes) == 0:
+        return None, []
+    boxes_array = np.array(boxes)
+    centers = np.stack((boxes_array[:, :2].mean(axis=1), boxes_array[:, 2:].mean(axis=1)), axis=1)
+    starts = (centers - pixels_from_center).astype(np.int32)
+    offsets = np.arange(2 * pixels_from_center + 1)
+    xs = (starts[:, 0, None] + offsets)[:, :, None]
+    ys = (starts[:, 1, None] + offsets)[:, None, :]
+    # squares indexed [pool, x, y] like in find_pools, so colors are the same
+    mean_colors = img[ys, xs].mean(axis=2).mean(axis=1)
+    return centers.tolist(), list(mean_colors)
+
+def find_pools(img, blob_method='contours'):
+    """
+    Finds pools on RGB image.
+
+    Parameters
+    ----------
+    img : numpy.ndarray
+        RGB image of shape (height, width, 3)
+    blob_method : string
+        'contours' - boxes of all contours of the mask (boxes_from_mask), holes inside pools
+        bigger than 5 pixels are reported as pools too,
+        'components' - boxes of connected components of the mask (blobs_from_mask), one box per blob
+
+    Returns
+    -------
+    Tuple (boxes, pixel_coords, mean_colors). Boxes are [x_min, x_max, y_min, y_max] lists,
+    pixel_coords are [x, y] centers of boxes (None if no pool was found) and mean_colors
+    are mean RGB colors of 7x7 squares around centers.
+    """
+    img_hsv = cv.cvtColor(img, cv.COLOR_RGB2HSV)
+    mask = pool_mask(img_hsv)
+    boxes = blobs_from_mask(mask) if blob_method == 'components' else boxes_from_mask(mask)
+    pixel_coords, mean_colors = describe_boxes(img, boxes)
+    return boxes, pixel_coords, mean_colors
+
+# shared memory blocks attached by this worker process
+_attached = {}
+
+def _detect_shared(name, shape, dtype, blob_method='contours'):
+    """
+    Runs find_pools with blob_method in worker process on image stored in shared memory block.
+    Returns compact arrays (boxes, pixel_coords, mean_colors).
+    """
+    block = _attached.get(name)
+    if block is None:
+        block = shared_memory.SharedMemory(name=name)
+        _attached[name] = block
+    img = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+    boxes, pixel_coords, mean_colors = find_pools(img, blob_method)
+    del img
+    return (np.array(boxes, dtype=np.int32).reshape(-1, 4),
+            None if pixel_coords is None else np.array(pixel_coords),
+            np.array(mean_colors).reshape(-1, 3))
@@ -1,25 +1,45 @@
 import overpy
-import time
+import gzip
 import json
+import logging
+import time
 import numpy as np
-from .utils import join_ways
-from shapely.geometry import Point
+from .utils import join_ways, ui_zooms, zoom_tolerance, simplify_rings, encode_polyline, polyline_length
+from ..OverpassScheduler.object import OverpassScheduler
+import shapely
 from shapely.geometry.polygon import Polygon
 from tqdm import tqdm
 
 class PoolPolygonsFinder:
-    def __init__(self):
-        self.osm = overpy.Overpass()
+    def __init__(self, url=None, store=None, offline=False, scheduler=None, tolerance=1e-6):
+        """
+        Parameters
+        ----------
+        url : str
+            Overpass API url, defaults to the public instance. Can point to local Overpass stand-in.
+        store : BoundaryStore
+            optional local store of boundaries, only regions missing in it are queried
+        offline : bool
+            if True, Overpass is never queried and only boundaries from the store are used
+        scheduler : OverpassScheduler
+            scheduler running the queries, defaults to the one shared by all finders using the url
+        tolerance : float
+            outer ways whose end points are at most tolerance degrees apart are joined (see join_ways)
+        """
+        self.scheduler = scheduler if scheduler is not None else OverpassScheduler.shared(url)
+        self.osm = self.scheduler.api
+        self.store = store
+        self.offline = offline
+        self.tolerance = tolerance
+        # ids of parsed relations with outer ways which could not be closed into rings
+        self.unclosed = []
 
     def osm_query(self, query):
         """
-        This method runs query and waits if too many requests exception is thrown.
+        This method runs query through the scheduler, which retries it with backoff if too many
+        requests exception is thrown and answers identical concurrent queries once.
         """
-        try:
-            return self.osm.query(query)
-        except overpy.exception.OverpassTooManyRequests:
-            time.sleep(60)
-            return self.osm_query(query)
+        return self.scheduler.query(query)
 
     def polygons_query(self, lat, lon, level):
         """
@@ -31,19 +51,106 @@ class PoolPolygonsFinder:
             List with range of latitude
         lon : list
             List with range of longitude
-        level : int
-            Administrative level of requested polygons
+        level : int or list
+            Administrative level of requested polygons or list of such levels fetched in one query
+
+        Result may contain more relations, when the query is answered by bigger or merged query of the scheduler.
         """
-        return self.osm_query("""
+        return self.scheduler.bbox_query(lat, lon, level, self.polygons_query_text)
+
+    @staticmethod
+    def polygons_query_text(lat, lon, level):
+        """
+        Returns text of the query of polygons_query.
+        """
+        if type(level) is list:
+            level_filter = '["admin_level"~"^({0})$"]'.format('|'.join(map(str, level)))
+        else:
+            level_filter = '["admin_level"={0}]'.format(level)
+        return """
         [out:json][timeout:120][bbox:{lat_min},{lon_min},{lat_max},{lon_max}];
         (
-          rel["boundary"="administrative"]["admin_level"={level}];
+          rel["boundary"="administrative"]{level_filter};
+          >;
+        );
+        out;
+        """.format(lat_min=lat[0], lat_max=lat[1], lon_min=lon[0], lon_max=lon[1], level_filter=level_filter)
+
+    def relations_query(self, ids):
+        """
+        This method makes QSM query to get relations with given ids.
+        """
+        return self.osm_query("""
+        [out:json][timeout:120];
+        (
+          rel(id:{0});
           >;
         );
         out;
-        """.format(lat_min=lat[0], lat_max=lat[1], lon_min=lon[0], lon_max=lon[1], level=level))
+        """.format(','.join(map(str, ids))))
 
-    def assign_polygons(self, pools, level=[4,6,8]):
+    def parse_relations(self, result):
+        """
+        Returns list of relations of Overpass result as dictionaries with id, level (admin_level tag),
+        name and rings (outer ways joined with join_ways with tolerance of the finder). Chains of ways
+        which could not be closed are left out of rings, ids of their relations are added to unclosed
+        and logged.
+        """
+        relations = []
+        for rel in result.relations:
+            ways = []
+            for way in [way.resolve() for way in rel.members if way.role=='outer' and isinstance(way, overpy.RelationWay)]:
+                ways.append(list(map(lambda n: (float(n.lat), float(n.lon)), way.nodes)))
+            unclosed = []
+            rings = join_ways(ways, self.tolerance, unclosed)
+            if len(unclosed) > 0:
+                rings = rings[:len(rings) - len(unclosed)]
+                self.unclosed.append(rel.id)
+                logging.getLogger(__name__).warning('Relation %s has %d unclosed chains of outer ways, they are left out',
+                                                    rel.id, len(unclosed))
+            relations.append({
+                'id': rel.id,
+                'level': rel.tags.get('admin_level'),
+                'name': rel.tags.get('name'),
+                'rings': rings
+            })
+        return relations
+
+    def boundaries(self, lat, lon, levels):
+        """
+        Gets administrative relations of all levels lying in given ranges. Without store all levels
+        are fetched with one query. With store only 1 x 1 degree cells missing in it are fetched,
+        with one query per rectangle of neighbouring missing cells, and the rest is read from the store.
+        In offline mode missing cells raise exception instead of returning incomplete boundaries.
+
+        Parameters
+        ----------
+        lat : list
+            List with range of latitude
+        lon : list
+            List with range of longitude
+        levels : list
+            Administrative levels of requested relations
+
+        Returns
+        ----------
+        Dictionary mapping level to list of relations (see parse_relations) ordered by id
+        """
+        if self.store is None:
+            if self.offline:
+                raise Exception('Offline mode requires boundary store')
+            relations = self.parse_relations(self.polygons_query(lat, lon, list(levels)))
+            return { level: [rel for rel in relations if rel['level'] == str(level)] for level in levels }
+        missing = self.store.missing_cells(self.store.cells(lat, lon), levels)
+        if len(missing) > 0 and self.offline:
+            raise Exception(f'Boundary store misses {len(missing)} cells of levels {list(levels)}, e.g. {missing[0]}')
+        for lats, lons in self.store.rectangles(missing):
+            result = self.polygons_query([lats[0], lats[1] + 1], [lons[0], lons[1] + 1], list(levels))
+            self.store.put_relations(self.parse_relations(result))
+            self.store.mark_cells(self.store.cells(lats, lons), levels)
+        return { level: self.store.relations_in_bbox(lat, lon, level) for level in levels }
+
+    def assign_polygons(self, pools, level=[4,6,8], indexes=None):
         """
         This method assigns administrative relation's (represents polygon) id to each pool.
         Parameters
@@ -52,34 +159,87 @@ class PoolPolygonsFinder:
             List of coordinates [lat, lng]
         level : int or list
             Administrative level of requested relations or list of such levels.
+        indexes : dict
+            Optional indexes of rings of every level (see level_indexes) built once for many lists
+            of pools, boundaries are not fetched then.
 
         Returns
         ----------
         List of relations' ids or list of such lists for each level
         """
-        if type(level) is list:
-            return [self.assign_polygons(pools, lev) for lev in tqdm(level)]
-        lats = list(map(lambda p: p[0], pools))
-        lons = list(map(lambda p: p[1], pools))
-        points = list(map(lambda p: Point(p[0], p[1]), pools))
-        lat_margin=1
-        lon_margin=1
-        result = self.polygons_query([min(lats) - lat_margin, max(lats) + lat_margin], [min(lons) - lon_margin, max(lons) + lon_margin], level)
-        polygons = [None]*len(pools)
-        for rel in result.relations:
-            ways = []
-            for way in [way.resolve() for way in rel.members if way.role=='outer' and isinstance(way, overpy.RelationWay)]:
-                ways.append(list(map(lambda n: (float(n.lat), float(n.lon)), way.nodes)))
-            nodes = join_ways(ways)
-            for path in nodes:
-                if len(path) < 3:
+        levels = level if type(level) is list else [level]
+        if indexes is None:
+            lats = list(map(lambda p: p[0], pools))
+            lons = list(map(lambda p: p[1], pools))
+            lat_margin=1
+            lon_margin=1
+            indexes = self.level_indexes([min(lats) - lat_margin, max(lats) + lat_margin], [min(lons) - lon_margin, max(lons) + lon_margin], levels)
+        polygons = [self.assign_points(pools, index=indexes[lev]) for lev in tqdm(levels)]
+        return polygons if type(level) is list else polygons[0]
+
+    def level_indexes(self, lat, lon, levels):
+        """
+        Gets boundaries of all levels lying in given ranges (see boundaries) and puts rings
+        of every level into STRtree (see index_rings).
+
+        Returns
+        ----------
+        Dictionary mapping level to (ids, tree) tuple
+        """
+        boundaries = self.boundaries(lat, lon, levels)
+        return { level: self.index_rings([(rel['id'], rel['rings']) for rel in boundaries[level]]) for level in levels }
+
+    @staticmethod
+    def index_rings(relations):
+        """
+        Puts rings of relations (list of (relation id, list of rings) tuples) into STRtree.
+        Returns (ids, tree) tuple, ids are relation ids of rings in the tree, tree is None if there are no rings.
+        """
+        ids = []
+        rings = []
+        for rel_id, paths in relations:
+            for path in paths:
+                # open chains (e.g. stored by older versions) are not polygons
+                if len(path) < 4 or tuple(path[0]) != tuple(path[-1]):
                     continue
-                polygon = Polygon(path)
-                for index, point in [(index, p) for (index, p) in enumerate(points) if polygon.contains(p)]:
-                    polygons[index] = rel.id
+                ids.append(rel_id)
+                rings.append(Polygon(path))
+        return ids, shapely.STRtree(rings) if len(rings) > 0 else None
+
+    @staticmethod
+    def assign_points(pools, relations=None, index=None):
+        """
+        Finds relation containing each pool. All rings are put into STRtree and containment
+        of all pools is tested in one vectorized query. If pool lies in many rings, the last
+        of them wins (like when rings are tested one by one in order of relations).
+
+        Parameters
+        ----------
+        pools : list
+            List of coordinates [lat, lng]
+        relations : list
+            List of (relation id, list of rings) tuples, rings are lists of (lat, lng) tuples
+        index : tuple
+            (ids, tree) tuple of index_rings used instead of relations, so the tree is built once
+
+        Returns
+        ----------
+        List of relations' ids, None for pools lying in no relation
+        """
+        ids, tree = index if index is not None else PoolPolygonsFinder.index_rings(relations)
+        polygons = [None] * len(pools)
+        if tree is None or len(pools) == 0:
+            return polygons
+        points = shapely.points(np.asarray(pools, dtype=np.float64).reshape(-1, 2))
+        point_index, ring_index = tree.query(points, predicate='within')
+        # index of the last ring containing every pool, -1 if there is none
+        last = np.full(len(pools), -1)
+        np.maximum.at(last, point_index, ring_index)
+        for index in np.nonzero(last >= 0)[0]:
+            polygons[index] = ids[last[index]]
         return polygons
 
-    def save_ui_polygons(self, ids, filename):
+    def save_ui_polygons(self, ids, filename, compact=False, zooms=ui_zooms, precision=5, compression=[]):
         """
         Generates data file for UI.
 
@@ -89,32 +249,85 @@ class PoolPolygonsFinder:
             List or matrix of relations ids.
         filename : str
             Path to output file
+        compact : bool
+            If True, rings of every relation are simplified once for each zoom of its level (see zooms)
+            and written as encoded polylines (see encode_polyline), otherwise all nodes are written.
+        zooms : dict
+            Admin level (str) to list of UI zoom levels, ring simplified for zoom z is shown up to zoom z.
+            Levels missing in it get one level of detail for zoom 16.
+        precision : int
+            Amount of decimal places of coordinates in compact file.
+        compression : list
+            Pre-compressed copies of the file to write next to it, 'gzip' (filename.gz) and / or
+            'brotli' (filename.br, requires brotli package).
+
+        Returns
+        ----------
+        Dictionary with amount of polygons, rings and points, sizes of written files in bytes
+        and time of the export in seconds.
         """
+        start = time.perf_counter()
         if not type(ids) is np.ndarray:
             ids = np.array(ids)
         ids = ids.flatten()
         ids = ids[ids != None]
-        ids_f = ','.join(map(str, np.unique(ids)))
-        result = self.osm_query("""
-        [out:json][timeout:120];
-        (
-          rel(id:{0});
-          >;
-        );
-        out;
-        """.format(ids_f))
+        unique_ids = np.unique(ids)
+        if self.store is None:
+            relations = self.parse_relations(self.relations_query(unique_ids))
+        else:
+            relations = self.store.get_relations(unique_ids)
+            missing = set(map(int, unique_ids)) - set(rel['id'] for rel in relations)
+            if len(missing) > 0 and not self.offline:
+                self.store.put_relations(self.parse_relations(self.relations_query(sorted(missing))))
+                relations = self.store.get_relations(unique_ids)
         counts = {str(row[0]): float(row[1]) for row in np.asarray(np.unique(ids, return_counts=True)).T}
+        report = {
+            'polygons': len(relations),
+            'rings': sum(len(rel['rings']) for rel in relations),
+            'points': sum(len(ring) for rel in relations for ring in rel['rings'])
+        }
         polygons = []
-        for rel in result.relations:
-            ways = []
-            for way in [way.resolve() for way in rel.members if way.role=='outer' and isinstance(way, overpy.RelationWay)]:
-                ways.append(list(map(lambda n: (float(n.lat), float(n.lon)), way.nodes)))
-            polygons.append({
-                "id": rel.id,
-                "nodes": join_ways(ways),
-                "name": rel.tags.get('name'),
-                "level": rel.tags.get('admin_level'),
-                "pools": counts.get(str(rel.id))
-            })
-        with open(filename, 'w') as outfile:
-            json.dump(polygons, outfile)
+        points = 0
+        for rel in relations:
+            polygon = {
+                "id": rel['id'],
+                "nodes": None,
+                "name": rel['name'],
+                "level": rel['level'],
+                "pools": counts.get(str(rel['id']))
+            }
+            if compact:
+                polygon['zooms'] = zooms.get(rel['level'], [16])
+                polygon['nodes'] = []
+                for zoom in polygon['zooms']:
+                    rings = simplify_rings(rel['rings'], zoom_tolerance(zoom))
+                    rings = [encode_polyline(ring, precision) for ring in rings]
+                    # rings collapsed by rounding to less than 4 positions are not valid GeoJSON rings
+                    rings = [ring for ring in rings if polyline_length(ring) >= 4]
+                    polygon['nodes'].append(rings)
+                    points += sum(map(polyline_length, rings))
+            else:
+                polygon['nodes'] = rel['rings']
+            polygons.append(polygon)
+        if compact:
+            data = json.dumps({ 'format': 'polyline', 'precision': precision, 'polygons': polygons }, separators=(',', ':'))
+            report['encoded_points'] = points
+        else:
+            data = json.dumps(polygons)
+        data = data.encode()
+        with open(filename, 'wb') as outfile:
+            outfile.write(data)
+        report['bytes'] = len(data)
+        for method in compression:
+            if method == 'gzip':
+                compressed, extension = gzip.compress(data, 9, mtime=0), '.gz'
+            elif method == 'brotli':
+                import brotli
+                compressed, extension = brotli.compress(data), '.br'
+            else:
+                raise Exception(f'Unknown compression {method}')
+            with open(filename + extension, 'wb') as outfile:
+                outfile.write(compressed)
+            report[method + '_bytes'] = len(compressed)
+        report['seconds'] = time.perf_counter() - start
+        return report
@@ -1,55 +1,260 @@
+import heapq
 import math
+import numpy as np
+import shapely
 
-def join_ways(ways):
+# zoom levels of the UI (DeepPoolUI Map) for which rings of relations of given admin level are simplified,
+# every level is shown in one zoom range, level 8 gets more levels of detail as it is shown when zooming in
+ui_zooms = {
+    '4': [7],
+    '6': [9],
+    '8': [11, 13, 16]
+}
+
+def _sequence(rope, reverse):
+    """
+    Materializes list of points of a chain stored as rope: ('leaf', points) or
+    ('cat', left, left_reverse, right, right_reverse) nodes, reversed if reverse is True.
+    """
+    points = []
+    stack = [(rope, reverse)]
+    while stack:
+        node, rev = stack.pop()
+        if node[0] == 'leaf':
+            points.extend(reversed(node[1]) if rev else node[1])
+        elif rev:
+            stack.append((node[1], not node[2]))
+            stack.append((node[3], not node[4]))
+        else:
+            stack.append((node[3], node[4]))
+            stack.append((node[1], node[2]))
+    return points
+
+def join_ways(ways, tolerance=0.0, unclosed=None):
     """
-    OSM ofter returns polygons as list of unsorted ways. This method joins those ways, that in returned list
+    OSM often returns polygons as list of unsorted ways. This method joins those ways, that in returned list
     each ways is one polygon.
 
+    Ways sharing end points are found with hash of end points and joined in near linear time (joined
+    ways are concatenated, so shared point is repeated). Ways may be reversed. On well formed relations
+    rings are the same as when the closest pair of ways is joined one by one.
+
     Parameters
     ----------
     ways : list
-        List of ways (list) of (lat, long) tuples. 
+        List of ways (list) of (lat, long) tuples.
+    tolerance : float
+        Ways whose end points are at most tolerance (in degrees) apart are joined too, closest first.
+        Chain whose ends are that close is closed by repeating its first point.
+    unclosed : list
+        Optional list, chains which could not be closed into rings are appended to it.
 
     Returns
     -------
-    List of cyclic ways. Each represent one polygon.
+    List of cyclic ways. Each represent one polygon. Chains which could not be closed are at the end.
     """
 
     if len(ways) == 0:
         return []
-    ways = ways.copy()
     out_ways = []
-    while len(ways) > 1:
-        new_ways = []
-        for w in ways:
-            last = len(w) - 1
-            if w[0][0] == w[last][0] and w[0][1] == w[last][1]:
-                out_ways.append(w)
-            else:
-                new_ways.append(w)
-        ways = new_ways
-        if len(ways) <= 1:
+    # open chains: sequence number -> [rope, reverse, start, end]
+    chains = {}
+    ends = {}
+    for seq, way in enumerate(ways):
+        start, end = tuple(way[0]), tuple(way[-1])
+        if start == end:
+            out_ways.append(way)
             continue
-        min_dist = (math.inf, None, None, None)
-        for w1 in range(len(ways)):
-            for w2 in range(w1 + 1, len(ways)):
-                for comb in range(4):
-                    edge1 = 0 if (comb % 2) else len(ways[w1]) - 1
-                    edge2 = 0 if (comb < 2) else len(ways[w2]) - 1
-                    p1 = ways[w1][edge1]
-                    p2 = ways[w2][edge2]
-                    dist = (p1[0] - p2[0])**2 + (p1[1] - p2[1])**2
-                    if dist < min_dist[0]:
-                        min_dist = (dist, w1, w2, comb)
-        way1 = ways[min_dist[1]].copy()
-        way2 = ways[min_dist[2]].copy()
-        if min_dist[3] % 2:
-            way1.reverse()
-        if min_dist[3] >= 2:
-            way2.reverse()
-        ways.pop(min_dist[2])
-        ways.pop(min_dist[1])
-        ways.append(way1 + way2)
-    if len(ways) == 1:
-        out_ways.append(ways[0])
+        chains[seq] = [('leaf', way), False, start, end]
+        ends.setdefault(start, set()).add(seq)
+        ends.setdefault(end, set()).add(seq)
+
+    def partners(seq):
+        chain = chains[seq]
+        return (ends[chain[2]] | ends[chain[3]]) - {seq}
+
+    def merge(seq1, seq2, reverse1, reverse2, new_seq):
+        chain1, chain2 = chains.pop(seq1), chains.pop(seq2)
+        for seq, chain in ((seq1, chain1), (seq2, chain2)):
+            ends[chain[2]].discard(seq)
+            ends[chain[3]].discard(seq)
+        start = chain1[3] if reverse1 else chain1[2]
+        end = chain2[2] if reverse2 else chain2[3]
+        rope = ('cat', chain1[0], chain1[1] != reverse1, chain2[0], chain2[1] != reverse2)
+        if start == end:
+            out_ways.append(_sequence(rope, False))
+            return None
+        chains[new_seq] = [rope, False, start, end]
+        ends.setdefault(start, set()).add(new_seq)
+        ends.setdefault(end, set()).add(new_seq)
+        return new_seq
+
+    # exact joins, in the order of joining the first way (and its first partner) having common end point
+    next_seq = len(ways)
+    heap = list(chains)
+    heapq.heapify(heap)
+    while heap:
+        seq1 = heapq.heappop(heap)
+        if seq1 not in chains:
+            continue
+        candidates = partners(seq1)
+        if len(candidates) == 0:
+            continue
+        seq2 = min(candidates)
+        chain1, chain2 = chains[seq1], chains[seq2]
+        if chain1[3] == chain2[2]:
+            reverse1, reverse2 = False, False
+        elif chain1[2] == chain2[2]:
+            reverse1, reverse2 = True, False
+        elif chain1[3] == chain2[3]:
+            reverse1, reverse2 = False, True
+        else:
+            reverse1, reverse2 = True, True
+        if merge(seq1, seq2, reverse1, reverse2, next_seq) is not None:
+            heapq.heappush(heap, next_seq)
+        next_seq += 1
+
+    if tolerance > 0 and len(chains) > 0:
+        # end points of remaining chains within tolerance, closest pairs are joined first
+        grid = {}
+        slots = []
+        for seq in sorted(chains):
+            for side in (0, 1):
+                point = chains[seq][2 + side]
+                cell = (math.floor(point[0] / tolerance), math.floor(point[1] / tolerance))
+                grid.setdefault(cell, []).append(len(slots))
+                slots.append(point)
+        pairs = []
+        for index, point in enumerate(slots):
+            cell = (math.floor(point[0] / tolerance), math.floor(point[1] / tolerance))
+            for i in range(cell[0] - 1, cell[0] + 2):
+                for j in range(cell[1] - 1, cell[1] + 2):
+                    for other in grid.get((i, j), ()):
+                        dist = math.hypot(point[0] - slots[other][0], point[1] - slots[other][1])
+                        if other > index and dist <= tolerance:
+                            pairs.append((dist, index, other))
+        pairs.sort()
+        # slot -> [chain sequence, side] of chain currently ending there, None when slot was joined
+        owner = {}
+        for index, seq in enumerate(sorted(chains)):
+            owner[2 * index] = [seq, 0]
+            owner[2 * index + 1] = [seq, 1]
+        by_chain = { seq: [2 * index, 2 * index + 1] for index, seq in enumerate(sorted(chains)) }
+        for _, slot1, slot2 in pairs:
+            if owner[slot1] is None or owner[slot2] is None:
+                continue
+            (seq1, side1), (seq2, side2) = owner[slot1], owner[slot2]
+            if seq1 == seq2:
+                # both ends of one chain, close it
+                chain = chains.pop(seq1)
+                ends[chain[2]].discard(seq1)
+                ends[chain[3]].discard(seq1)
+                points = _sequence(chain[0], chain[1])
+                out_ways.append(points + [points[0]])
+                owner[slot1] = owner[slot2] = None
+                continue
+            free1 = by_chain.pop(seq1)
+            free2 = by_chain.pop(seq2)
+            free1.remove(slot1)
+            free2.remove(slot2)
+            owner[slot1] = owner[slot2] = None
+            # joined end of first chain must be its end, joined end of second chain its start
+            new_seq = next_seq
+            next_seq += 1
+            if merge(seq1, seq2, side1 == 0, side2 == 1, new_seq) is None:
+                owner[free1[0]] = owner[free2[0]] = None
+                continue
+            by_chain[new_seq] = free1 + free2
+            owner[free1[0]] = [new_seq, 0]
+            owner[free2[0]] = [new_seq, 1]
+
+    for seq in sorted(chains):
+        points = _sequence(chains[seq][0], chains[seq][1])
+        out_ways.append(points)
+        if unclosed is not None:
+            unclosed.append(points)
     return out_ways
+
+
+def zoom_tolerance(zoom):
+    """
+    Returns simplification tolerance (in degrees) invisible on web mercator map of given zoom, half of pixel at equator.
+    """
+    return 360 / (256 * 2 ** zoom) / 2
+
+def simplify_rings(rings, tolerance):
+    """
+    Simplifies rings with Douglas-Peucker algorithm preserving topology (rings never become invalid or
+    collapse). Rings with less than 3 points are skipped.
+
+    Parameters
+    ----------
+    rings : list
+        List of rings (list) of (lat, long) tuples
+    tolerance : float
+        Maximal distance (in degrees) of simplified ring from the original one
+
+    Returns
+    -------
+    List of simplified rings as numpy arrays of shape (n, 2).
+    """
+    rings = [ring for ring in rings if len(ring) >= 3]
+    if len(rings) == 0:
+        return []
+    geometries = shapely.simplify([shapely.linearrings(ring) for ring in rings], tolerance, preserve_topology=True)
+    coords, index = shapely.get_coordinates(geometries, return_index=True)
+    return np.split(coords, np.flatnonzero(np.diff(index)) + 1)
+
+def encode_polyline(points, precision=5):
+    """
+    Encodes points with encoded polyline algorithm: coordinates are rounded to precision decimal places,
+    differences of consecutive points are written as variable length base64-like characters.
+    Points equal to previous ones after rounding are skipped.
+
+    Parameters
+    ----------
+    points : list or numpy.ndarray
+        (lat, long) points
+    precision : int
+        Amount of decimal places kept, 5 means about 1 meter
+
+    Returns
+    -------
+    Encoded polyline string.
+    """
+    values = np.round(np.asarray(points, dtype=np.float64).reshape(-1, 2) * 10 ** precision).astype(np.int64)
+    if len(values) == 0:
+        return ''
+    keep = np.ones(len(values), dtype=bool)
+    keep[1:] = np.any(values[1:] != values[:-1], axis=1)
+    values = values[keep]
+    deltas = np.diff(values, axis=0, prepend=np.zeros((1, 2), dtype=np.int64)).ravel()
+    zigzag = np.where(deltas < 0, ~(deltas << 1), deltas << 1)
+    shifts = 5 * np.arange(8)
+    chunks = (zigzag[:, None] >> shifts) & 31
+    count = 1 + np.sum(zigzag[:, None] >= (1 << shifts[1:]), axis=1)
+    chunks[np.arange(8) < count[:, None] - 1] |= 32
+    return (chunks[np.arange(8) < count[:, None]] + 63).astype(np.uint8).tobytes().decode('ascii')
+
+def polyline_length(text):
+    """
+    Returns amount of points of encoded polyline string (see encode_polyline) without decoding it.
+    """
+    # last character of every value is below 95 (63 + 32), every point has two values
+    return sum(1 for char in text if ord(char) < 95) // 2
+
+def decode_polyline(text, precision=5):
+    """
+    Decodes encoded polyline string (see encode_polyline) into list of (lat, long) tuples.
+    """
+    values = []
+    value = shift = 0
+    for char in text:
+        chunk = ord(char) - 63
+        value |= (chunk & 31) << shift
+        shift += 5
+        if chunk < 32:
+            values.append(~(value >> 1) if value & 1 else value >> 1)
+            value = shift = 0
+    coords = np.cumsum(np.asarray(values, dtype=np.int64).reshape(-1, 2), axis=0) / 10 ** precision
+    return list(map(tuple, coords.tolist()))
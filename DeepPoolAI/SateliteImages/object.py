@@ -1,24 +1,90 @@
 import json
+import os
 import random
+import threading
 import time
-import random
-import time
+import uuid
 import numpy as np
-import matplotlib.pyplot as plt
-from copy import deepcopy
+import cv2 as cv
+from copy import copy, deepcopy
+from io import BytesIO
 from urllib.request import urlopen
 from PIL import Image
 from tqdm import tqdm
 from bson.objectid import ObjectId
-from .utils import  coverTerrain, _PixelXYToLatLong, _LatLongToPixelXY, coverPolygon
-from ..PoolDetector.object import PoolDetector
+from .utils import  coverTerrain, _PixelXYToLatLongArray, _LatLongToPixelXY, _LatLongToPixelXYArray, coverPolygon, \
+    _GroundResolution
+from ..HttpPool.object import HttpPool
+from ..Pipeline.object import Pipeline, Stage
+from ..PoolDetector.object import PoolDetector, DetectorPool
+from ..PoolDetector.utils import decode_photo, pool_mask, blob_methods
 from ..PoolDatabase.object import PoolDatabase
 from ..PoolAddressParser.object import PoolAddressParser
-from ..PoolPolygonsFinder.object import PoolPolygonsFinder
+
+def _pools_lat_long(coord, pixel_coords, zoomLevel, width, height):
+    """
+    Converts pixel coordinates of pools detected on photo centered at coord
+    to lists of latitudes and longitudes.
+    """
+    x, y = _LatLongToPixelXY(coord[0], coord[1], zoomLevel)
+    pixel_coords = np.floor(np.asarray(pixel_coords, dtype=np.float64).reshape(-1, 2))
+    lats, longs = _PixelXYToLatLongArray(x + pixel_coords[:, 0] - width // 2,
+                                         y + pixel_coords[:, 1] - height // 2, zoomLevel)
+    return lats.tolist(), longs.tolist()
+
+
+class ImageryProvider:
+    """Imagery Provider
+    Interface of aerial photos sources used by GridPhotos and PolygonPhotos.
+    Subclasses set zoomLevel, width and height attributes and implement get_photo.
+    """
+
+    def get_photo(self, lat, long):
+        """ Get Photo
+        Gets photo of size width x height centered at given lat, long.
+
+        Parameters
+        ----------
+        lat : double
+            latitude
+        long : double
+            longitude
+
+        Returns
+        -------
+        Photo as PIL image or numpy array of shape (height, width, 3) in RGB
+        """
+        raise NotImplementedError
+
+    def get_array(self, lat, long, out=None):
+        """ Get Array
+        Gets photo centered at given lat, long as RGB numpy array.
+
+        Parameters
+        ----------
+        lat : double
+            latitude
+        long : double
+            longitude
+        out : numpy.ndarray
+            optional buffer of shape (height, width, 3) reused by providers decoding photos
+
+        Returns
+        -------
+        numpy array of shape (height, width, 3) in RGB
+        """
+        return np.asarray(self.get_photo(lat, long))
+
+    def with_zoom(self, zoomLevel):
+        """
+        Returns provider of photos of the same size at other zoom level. Used by adaptive scanning.
+        """
+        raise NotImplementedError
+
 
 class SquareAerialImage:
 
-    def __init__(self, key, zoomLevel):
+    def __init__(self, key, zoomLevel, cache=None):
         """Square Aerial Image
         Wrapper for Bing api
 
@@ -28,6 +94,8 @@ class SquareAerialImage:
             Bing Api key
         zoomLevel : integer
             integer between [1,21], amount of zoom in the picture
+        cache : TileCache
+            optional on-disk cache of downloaded images
 
         Returns
         -------
@@ -36,6 +104,7 @@ class SquareAerialImage:
 
         self.key = key
         self.zoomLevel = zoomLevel
+        self.cache = cache
 
         return
 
@@ -55,6 +124,13 @@ class SquareAerialImage:
         -------
         Square photo without label on lower bound
         """
+        if self.cache is None:
+            return Image.open(BytesIO(self._get_square_photo_bytes(lat, long)))
+        data = self.cache.get_or_fetch(self.cache.key('square', lat, long, self.zoomLevel),
+                                       lambda: self._get_square_photo_bytes(lat, long))
+        return Image.open(BytesIO(data))
+
+    def _get_square_photo_bytes(self, lat, long):
         request = urlopen("https://dev.virtualearth.net/REST/V1/Imagery/Metadata/Aerial/"
                           f"{lat},{long}?zl={self.zoomLevel}"
                           "&o&"  # json
@@ -62,12 +138,11 @@ class SquareAerialImage:
 
         json_request = json.loads(request.read())
         image_url = json_request['resourceSets'][0]['resources'][0]['imageUrl']
-        image = Image.open(urlopen(image_url))
 
-        return image
+        return urlopen(image_url).read()
 
 
-class AerialImage(SquareAerialImage):
+class AerialImage(SquareAerialImage, ImageryProvider):
     """Square Aerial Image
       Wrapper for Bing api. Extension for square aerial image.
       It is possible to get rectangle images via width and height
@@ -84,16 +159,21 @@ class AerialImage(SquareAerialImage):
 
       width : integer
           width of an aerial map in pixels
+      http : HttpPool
+          optional pool of keep-alive connections used instead of urlopen
+      cache : TileCache
+          optional on-disk cache of downloaded images
 
       Returns
       -------
       AerialImage object that stores information about key, zoom, height and width of an image
     """
 
-    def __init__(self, key, zoomLevel, width=1080, height=720):
-        super().__init__(key, zoomLevel)
+    def __init__(self, key, zoomLevel, width=1080, height=720, http=None, cache=None):
+        super().__init__(key, zoomLevel, cache)
         self.height = height
         self.width = width
+        self.http = http
 
     def get_photo(self, lat, long):
         """ Get Photo
@@ -114,12 +194,62 @@ class AerialImage(SquareAerialImage):
 
         """
 
+        return Image.open(BytesIO(self.get_photo_bytes(lat, long)))
+
+    def get_array(self, lat, long, out=None):
+        """ Get Array
+        Gets photo of area given the long, lat as RGB numpy array. Downloaded (or cached)
+        bytes are decoded directly, without PIL image in between.
+
+        Parameters
+        ----------
+        lat : double
+            latitude
+        long : double
+            longitude
+        out : numpy.ndarray
+            optional buffer of shape (height, width, 3) the photo is written to
+
+        Returns
+        -------
+        numpy array of shape (height, width, 3) in RGB
+        """
+        return decode_photo(self.get_photo_bytes(lat, long), out)
+
+    def with_zoom(self, zoomLevel):
+        """
+        Returns AerialImage of the same size at other zoom level sharing key, http pool and cache.
+        """
+        return AerialImage(self.key, zoomLevel, self.width, self.height, self.http, self.cache)
+
+    def get_photo_bytes(self, lat, long):
+        """ Get Photo Bytes
+        Downloads encoded photo of area given the long, lat.
+        Uses cache and http pool of the object if they are set.
+
+        Parameters
+        ----------
+        lat : double
+            latitude
+        long : double
+            longitude
+
+        Returns
+        -------
+        Encoded jpeg image as bytes
+        """
+        if self.cache is None:
+            return self._download_photo(lat, long)
+        key = self.cache.key(lat, long, self.zoomLevel, self.width, self.height)
+        return self.cache.get_or_fetch(key, lambda: self._download_photo(lat, long))
+
+    def _download_photo(self, lat, long):
         request = f"https://dev.virtualearth.net/REST/v1/Imagery/Map/Aerial/{lat},{long}/{self.zoomLevel}?" \
                   f"mapSize={self.width},{self.height}&key={self.key}"
 
-        image = Image.open(urlopen(request))
-
-        return image
+        if self.http is None:
+            return urlopen(request).read()
+        return self.http.get(request)
 
     def get_coords(self, lat1, long1, lat2, long2):
         """
@@ -138,6 +268,8 @@ class AerialImage(SquareAerialImage):
         Returns a tuple (array_of_photos, plt)
         """
 
+        # matplotlib is imported only when grid is plotted
+        import matplotlib.pyplot as plt
         coords = self.get_coords(lat1, long1, lat2, long2)
         if len(list(coords.shape)) != 3:
             raise Exception("You should bet a bit bigger terrain, grid should be at least 2x2 to work")
@@ -157,12 +289,126 @@ class AerialImage(SquareAerialImage):
         return photos, plt
 
 
+class LocalMosaicProvider(ImageryProvider):
+    """Local Mosaic Provider
+      Offline source of aerial photos. Reads large orthophoto mosaic stored as
+      .npy or raw file (or set of such tiles) with memory mapping and returns
+      windows of it without copying.
+
+      Georeference sidecar is a json file (by default path + '.json'):
+        {
+            "zoomLevel": 19,            # level of detail of mosaic pixels
+            "pixelX": 23877120,         # global pixel coordinates of upper-left corner,
+            "pixelY": 52592640,         # or "lat" and "long" of that corner
+            "shape": [20000, 30000, 3], # raw files only
+            "dtype": "uint8",           # raw files only
+            "offset": 0,                # raw files only, header size in bytes
+            "tiles": [                  # optional, mosaic split into many files
+                {"path": "0_0.npy", "pixelX": 23877120, "pixelY": 52592640}
+            ]
+        }
+      Files hold RGB pixels in row major (height, width, 3) layout.
+
+      Parameters
+      ----------
+      path : string
+          path to .npy or raw mosaic file, or to the sidecar of tiled mosaic
+      width : integer
+          width of returned photos in pixels
+      height : integer
+          height of returned photos in pixels
+      georef : string
+          path to the georeference sidecar, defaults to path + '.json'
+
+      Returns
+      -------
+      LocalMosaicProvider object
+    """
+
+    def __init__(self, path, width, height, georef=None):
+        if georef is None:
+            georef = path if path.endswith('.json') else path + '.json'
+        with open(georef, 'r') as f:
+            meta = json.load(f)
+        self.zoomLevel = meta['zoomLevel']
+        self.width = width
+        self.height = height
+        self.mosaics = []
+        if 'tiles' in meta:
+            tiles = [(os.path.join(os.path.dirname(georef), tile['path']), tile) for tile in meta['tiles']]
+        else:
+            tiles = [(path, meta)]
+        for tile_path, tile in tiles:
+            if tile_path.endswith('.npy'):
+                array = np.load(tile_path, mmap_mode='r')
+            else:
+                array = np.memmap(tile_path, dtype=tile.get('dtype', 'uint8'), mode='r',
+                                  offset=tile.get('offset', 0), shape=tuple(tile['shape']))
+            if 'pixelX' in tile:
+                x, y = tile['pixelX'], tile['pixelY']
+            else:
+                x, y = _LatLongToPixelXY(tile['lat'], tile['long'], self.zoomLevel)
+            self.mosaics.append((x, y, array))
+
+    def get_photo(self, lat, long):
+        """ Get Photo
+        Gets window of the mosaic centered at lat, long. Window lying inside single file
+        is a read-only view of memory mapped data, otherwise it is assembled from
+        overlapping files and parts outside of the mosaic are black.
+
+        Parameters
+        ----------
+        lat : double
+            latitude
+        long : double
+            longitude
+
+        Returns
+        -------
+        numpy array of shape (height, width, 3)
+        """
+        px, py = _LatLongToPixelXY(lat, long, self.zoomLevel)
+        x0 = px - self.width // 2
+        y0 = py - self.height // 2
+        x1 = x0 + self.width
+        y1 = y0 + self.height
+        for x, y, array in self.mosaics:
+            if x <= x0 and y <= y0 and x1 <= x + array.shape[1] and y1 <= y + array.shape[0]:
+                return array[y0 - y:y1 - y, x0 - x:x1 - x]
+        photo = np.zeros((self.height, self.width, 3), dtype=np.uint8)
+        for x, y, array in self.mosaics:
+            left, right = max(x0, x), min(x1, x + array.shape[1])
+            top, bottom = max(y0, y), min(y1, y + array.shape[0])
+            if left < right and top < bottom:
+                photo[top - y0:bottom - y0, left - x0:right - x0] = array[top - y:bottom - y, left - x:right - x]
+        return photo
+
+    def with_zoom(self, zoomLevel):
+        """
+        Returns provider reading the same mosaic at lower zoom level. Every 2 ** (levels difference)-th
+        pixel of the mosaic is taken (strided views, nothing is copied).
+        """
+        if zoomLevel > self.zoomLevel:
+            raise Exception('Mosaic can not be read at higher zoom level than its own')
+        step = 2 ** (self.zoomLevel - zoomLevel)
+        provider = copy(self)
+        provider.zoomLevel = zoomLevel
+        provider.mosaics = []
+        for x, y, array in self.mosaics:
+            # first pixels lying on the coarse grid
+            left, top = -x % step, -y % step
+            provider.mosaics.append(((x + left) // step, (y + top) // step, array[top::step, left::step]))
+        return provider
+
+
 class GridPhotos:
 
-    def __init__(self, lat1, long1, lat2, long2, key, zoomLevel, width, height, coverage=1, sleep_range=[0, 0]):
+    def __init__(self, lat1, long1, lat2, long2, key, zoomLevel, width, height, coverage=1, sleep_range=[0, 0], cache=None,
+                 provider=None):
 
-        ai = AerialImage(key, zoomLevel, width, height)
-        self.ai = ai
+        if provider is None:
+            provider = AerialImage(key, zoomLevel, width, height, cache=cache)
+        self.ai = provider
 
         self.width = width
         self.height = height
@@ -178,30 +424,46 @@ class GridPhotos:
         self.coverage = coverage
         self.sleep_range = sleep_range
 
-    def fit(self):
+    def fit(self, processes=None):
+        """
+        Detects pools on the grid. If processes is given, detection runs in
+        that many worker processes (DetectorPool) while next photos are downloaded.
+        """
         coords = self.coords
         # no matter the grid
         coords = deepcopy(coords.flatten().reshape(1, coords.shape[0] * coords.shape[1], 2)[0])
+        coords = list(filter(lambda c: random.random() < self.coverage, coords))
+
+        def photos():
+            # detected photos are not kept, so one buffer is reused for all of them
+            photo = None
+            for coord in coords:
+                time.sleep(random.uniform(self.sleep_range[0], self.sleep_range[1]))
+                photo = self.ai.get_array(coord[0], coord[1], photo)
+                yield photo
+
+        def detect_serial():
+            for photo in photos():
+                pd = PoolDetector(photo)
+                pd.get_pools()
+                yield pd
 
+        detector_pool = DetectorPool(processes) if processes else None
+        detectors = detector_pool.imap(photos()) if detector_pool is not None else detect_serial()
         pool_coordinates = []
-        for coord in tqdm(list(filter(lambda c: random.random() < self.coverage, coords))):
-            time.sleep(random.uniform(self.sleep_range[0], self.sleep_range[1]))
-            pd = PoolDetector(self.ai.get_photo(coord[0], coord[1]))
-            pd.get_pools()
-            self.cleanness = np.append(self.cleanness, np.where(np.array(pd.mean_colors)[:, 1] - 15 >
-                                        np.array(pd.mean_colors)[:, 2],
-                                         'not-clean', 'clean'))
-
-            middle_x = self.width // 2
-            middle_y = self.height // 2
-            if pd.pixel_coords is not None:
-                for pool_coord in np.floor(pd.pixel_coords):
-                    x, y = _LatLongToPixelXY(coord[0], coord[1], self.zoomLevel)
-                    diff_x = pool_coord[0] - middle_x
-                    diff_y = pool_coord[1] - middle_y
-                    lat, long = _PixelXYToLatLong(x + diff_x, y + diff_y, self.zoomLevel)
-                    pool_coordinates.append([lat, long])
-            pd = None
+        try:
+            for coord, pd in tqdm(zip(coords, detectors), total=len(coords)):
+                self.cleanness = np.append(self.cleanness, np.where(np.array(pd.mean_colors)[:, 1] - 15 >
+                                            np.array(pd.mean_colors)[:, 2],
+                                            'not-clean', 'clean'))
+
+                if pd.pixel_coords is not None:
+                    lats, longs = _pools_lat_long(coord, pd.pixel_coords, self.zoomLevel, self.width, self.height)
+                    pool_coordinates.extend([lat, long] for lat, long in zip(lats, longs))
+                pd = None
+        finally:
+            if detector_pool is not None:
+                detector_pool.close()
 
         self.pool_coords = pool_coordinates
 
@@ -231,6 +493,50 @@ class GridPhotos:
             raise Exception("No photos found - you need to load grid by get_grid() first")
         return self.photos[i]
 
+class PoolIndex:
+
+    def __init__(self, zoomLevel, radius, latitude):
+        """Pool Index
+        Spatial hash of pool coordinates in global pixel space of zoomLevel. Used to find the same
+        pool detected on two neighbouring tiles. Radius in meters is converted to pixels with
+        ground resolution at latitude of every pool.
+
+        Parameters
+        ----------
+        zoomLevel : integer
+            zoom level of pixel space
+        radius : double
+            pools closer than radius meters are duplicates
+        latitude : double
+            latitude used to choose size of grid cells, e.g. of the batch polygon
+
+        Returns
+        -------
+        PoolIndex object
+        """
+        self.zoomLevel = zoomLevel
+        self.radius = radius
+        self.cell = max(1.0, radius / _GroundResolution(latitude, zoomLevel))
+        self.cells = {}
+
+    def add(self, lat, long):
+        """
+        Adds pool to the index if there is no other pool within radius.
+        Returns True if pool was added, False if it is a duplicate.
+        """
+        x, y = _LatLongToPixelXY(lat, long, self.zoomLevel)
+        radius = self.radius / _GroundResolution(lat, self.zoomLevel)
+        cx, cy = int(x // self.cell), int(y // self.cell)
+        reach = int(np.ceil(radius / self.cell))
+        for i in range(cx - reach, cx + reach + 1):
+            for j in range(cy - reach, cy + reach + 1):
+                for px, py in self.cells.get((i, j), ()):
+                    if (px - x) ** 2 + (py - y) ** 2 <= radius ** 2:
+                        return False
+        self.cells.setdefault((cx, cy), []).append((x, y))
+        return True
+
+
 class Pool:
     exportable_fields = ['coordinates', '_id', 'color', 'clean', 'address', 'osm', 'batch']
     def __init__(self, lat, lng, batch):
@@ -242,14 +548,30 @@ class Pool:
         self.osm = None
         self._id = None
 
-    def find_address(self, key):
+    def find_address(self, key, parser=None):
         if self.address is None:
-            parser = PoolAddressParser(key)
+            if parser is None:
+                parser = PoolAddressParser(key)
             try:
                 self.address = parser.get_addresses([self.coordinates], verbose=False)[0]
             except:
                 pass
 
+    @staticmethod
+    def find_addresses(pools, parser):
+        """
+        Reverse-geocodes all pools without address with one geocode_many call of the parser.
+        Returns list of errors of pools which could not be geocoded.
+        """
+        pools = [pool for pool in pools if pool.address is None]
+        errors = []
+        for pool, result in zip(pools, parser.geocode_many([pool.coordinates for pool in pools])):
+            if result.get('error') is None:
+                pool.address = result
+            else:
+                errors.append(result)
+        return errors
+
     def export_to_db(self, db):
         if self._id is None:
             self._id = ObjectId()
@@ -273,11 +595,14 @@ class Pool:
         self.clean = self.color[1] - 15 <= self.color[2]
         
 class PolygonPhotos:
-    exportable_fields = ['nodes', 'todo', 'done', '_id', 'width', 'height', 'zoomLevel', 'progress', 'is_working', 'name', 'osm_done', 'pools_detected', 'working_machine']
+    exportable_fields = ['nodes', '_id', 'width', 'height', 'zoomLevel', 'progress', 'is_working', 'name', 'osm_done', 'pools_detected', 'working_machine', 'tiles_total', 'tiles_done', 'working_machines', 'tiles_skipped', 'adaptive_zoom', 'pools_merged', 'geocode_errors']
 
-    def __init__(self, nodes, key, zoomLevel, width, height, name='unnamed'):
-        ai = AerialImage(key, zoomLevel, width, height)
-        self.ai = ai
+    def __init__(self, nodes, key, zoomLevel, width, height, name='unnamed', cache=None, provider=None, cover=True):
+        if provider is None:
+            provider = AerialImage(key, zoomLevel, width, height, cache=cache)
+        if provider.zoomLevel != zoomLevel or provider.width != width or provider.height != height:
+            raise Exception('Provider zoom level and photo size must match the batch')
+        self.ai = provider
         self.key = key
         self.width = width
         self.height = height
@@ -285,45 +610,62 @@ class PolygonPhotos:
         self.photos = None
         self.pool_coords = []
         self.nodes = nodes
-        self.todo = coverPolygon(nodes, zoomLevel, width, height)
-        self.done = []
+        # tiles are kept in memory only until the batch is exported, later they live in the tiles collection
+        self.todo = coverPolygon(nodes, zoomLevel, width, height) if cover else None
+        self.tiles_total = len(self.todo) if cover else 0
+        self.tiles_done = 0
+        self.tiles_skipped = 0
+        self.pools_merged = 0
+        self.geocode_errors = 0
+        self.adaptive_zoom = None
         self.is_working = False
         self.progress = 0
         self.working_machine = None
+        self.working_machines = []
         self.name = name
         self.pool_buffer = []
         self._id = None
         self.osm_done = False
         self.pools_detected = 0
 
-    def get_osm_data(self, working_machine=None):
+    def get_osm_data(self, working_machine=None, finder=None, levels=[4, 6, 8], chunk_size=1000):
+        """
+        Assigns administrative relations of given levels (default 4, 6 and 8) to pools of the batch, which
+        miss any of them. Pools are read in chunks of chunk_size and only their osm field is updated, so
+        assignment may run while detection of the batch is in progress and repeated run assigns only new pools.
+        Batch is marked osm_done when detection is not running and all pools are assigned. Boundaries
+        around the batch polygon are fetched and indexed once, before the first chunk, chunks only query the index.
+        Optional finder (PoolPolygonsFinder) may use local boundary store or other Overpass instance.
+        """
         db = PoolDatabase()
-        self.update()
-        if self.is_working:
+        if not db.start_osm(self._id, working_machine):
             raise Exception('Already running')
-        self.working_machine = working_machine
-        self.is_working = True
-        self.progress = -1 # unncountable progress
-        self.export_to_db()
-
-        pools = db.get_pools_for_batch(self._id)
-        pools = list(map(lambda x: Pool.import_obj(x), pools))
-        coords = list(map(lambda x: x.coordinates, pools))
-        ppf = PoolPolygonsFinder()
-        levels = [4, 6, 8]
-        polygons = ppf.assign_polygons(coords, level=levels)
-        for index, pool in enumerate(pools):
-            pool.osm = { 'lvl_' + str(k): polygons[i][index] for i, k in enumerate(levels) }
-            pool.export_to_db(db)
-        self.osm_done = True
-        self.is_working = False
-        self.export_to_db()
+        try:
+            ppf = finder
+            if ppf is None:
+                from ..PoolPolygonsFinder.object import PoolPolygonsFinder
+                ppf = PoolPolygonsFinder()
+            indexes = None
+            for chunk in db.iter_pools_without_osm(self._id, levels, chunk_size):
+                if indexes is None:
+                    # same 1 degree margin as assign_polygons, tiles reach out of the polygon
+                    lats = [node[0] for node in self.nodes]
+                    lons = [node[1] for node in self.nodes]
+                    indexes = ppf.level_indexes([min(lats) - 1, max(lats) + 1], [min(lons) - 1, max(lons) + 1], levels)
+                coords = [pool['coordinates']['coordinates'] for pool in chunk]
+                polygons = ppf.assign_polygons(coords, level=levels, indexes=indexes)
+                db.set_pools_osm([(pool['_id'], dict(pool.get('osm') or {}, **{ 'lvl_' + str(k): polygons[i][index] for i, k in enumerate(levels) }))
+                                  for index, pool in enumerate(chunk)])
+        finally:
+            self.osm_done = db.finish_osm(self._id, levels)
 
     @staticmethod
-    def import_from_db(key, _id):
+    def import_from_db(key, _id, cache=None, provider=None):
         db = PoolDatabase()
-        batch = db.get_batch(_id, geo_fields=['done', 'todo', 'nodes'])
-        obj = PolygonPhotos(batch.get('nodes'), key, batch.get('zoomLevel'), batch.get('width'), batch.get('height'))
+        db.migrate_batch_tiles(_id)
+        batch = db.get_batch(_id, geo_fields=['nodes'])
+        obj = PolygonPhotos(batch.get('nodes'), key, batch.get('zoomLevel'), batch.get('width'), batch.get('height'),
+                            cache=cache, provider=provider, cover=False)
         for field in PolygonPhotos.exportable_fields:
             obj.__setattr__(field, batch.get(field))
         return obj
@@ -332,7 +674,7 @@ class PolygonPhotos:
         if self._id is None:
             return
         db = PoolDatabase()
-        batch = db.get_batch(self._id, geo_fields=['done', 'todo', 'nodes'])
+        batch = db.get_batch(self._id, geo_fields=['nodes'])
         for field in PolygonPhotos.exportable_fields:
             self.__setattr__(field, batch.get(field))
 
@@ -344,49 +686,349 @@ class PolygonPhotos:
         self.pools_detected += len(self.pool_buffer)
         for field in self.exportable_fields:
             data[field] = self.__getattribute__(field)
-        db.set_batch(data, geo_fields=['done', 'todo', 'nodes'])
+        db.set_batch(data, geo_fields=['nodes'])
+        if self.todo is not None:
+            db.set_tiles(self._id, self.todo)
+            self.todo = None
         for pool in self.pool_buffer:
             pool.export_to_db(db)
         self.pool_buffer = []
 
-    def fit(self, coverage=1, sleep_range=[0, 1], working_machine=None):
+    def checkpoint(self, db, tiles, expected, start_done, stats=None, merged=0, machine_id=None):
+        """
+        Saves pools of finished tiles (list of (tile index, pools) tuples), marks tiles as done and updates
+        progress with small delta updates instead of rewriting the whole batch. If machine_id is given,
+        pools of tiles whose lease expired and was taken over by other worker are dropped, that worker
+        saves them. Progress is the part of expected tiles done since the start of the run, counted by
+        tiles_done of the batch (start_done tiles were done before), so it includes work of other workers.
+        Optional pipeline statistics are saved as pipeline_stats of the batch and amount of
+        dropped duplicates is added to pools_merged. Saved pools which could not be geocoded
+        (have no address) are added to geocode_errors.
+        """
+        indices = [index for index, _ in tiles]
+        owned = set(db.leased_tiles(self._id, machine_id, indices)) if machine_id is not None else set(indices)
+        self.pool_buffer = [pool for index, pools in tiles if index in owned for pool in pools]
+        for pool in self.pool_buffer:
+            pool.export_to_db(db)
+        self.tiles_done += db.mark_tiles_done(self._id, sorted(owned), machine_id=machine_id)
+        self.pools_detected += len(self.pool_buffer)
+        tiles_done = db.get_batch_fields(self._id, ['tiles_done']).get('tiles_done') or 0
+        self.progress = min(1, (tiles_done - start_done) / expected) if expected > 0 else 1
+        fields = { 'progress': self.progress }
+        if stats is not None:
+            fields['pipeline_stats'] = stats
+        errors = sum(pool.address is None for pool in self.pool_buffer)
+        self.pools_merged = (self.pools_merged or 0) + merged
+        self.geocode_errors = (self.geocode_errors or 0) + errors
+        db.update_batch(self._id, fields, inc={ 'pools_detected': len(self.pool_buffer), 'pools_merged': merged,
+                                                'geocode_errors': errors })
+        self.pool_buffer = []
+
+    def iter_leased_tiles(self, db, machine_id, coverage, lease_size, lease_seconds):
+        """
+        Leases chunks of free tiles until none is left and yields (index, coord) of those chosen by coverage.
+        Tiles not chosen by coverage are released at once and leasing continues after the last leased
+        index, so they are not leased again in this run.
+        """
+        after = -1
+        while True:
+            tiles = db.lease_tiles(self._id, machine_id, lease_size, lease_seconds, after)
+            if len(tiles) == 0:
+                return
+            chosen = [random.random() < coverage for _ in tiles]
+            db.release_tiles(self._id, machine_id, [tile[0] for tile, keep in zip(tiles, chosen) if not keep])
+            if coverage < 1:
+                after = tiles[-1][0]
+            for tile, keep in zip(tiles, chosen):
+                if keep:
+                    yield tile
+
+    def geocode_pools(self, workers=8, rate_limit=None, max_retries=5, chunk_size=1000, cache=None):
+        """ Geocode Pools
+        Reverse-geocodes all pools of the batch which have no address yet (e.g. failed during fit)
+        in bulk and saves their addresses.
+
+        Parameters
+        ----------
+        workers : integer
+            amount of concurrent requests
+        rate_limit : double
+            maximal amount of requests per second, None disables limit
+        max_retries : integer
+            how many times throttled or failed request is repeated
+        chunk_size : integer
+            amount of pools geocoded and saved at once
+        cache : GeocodeCache
+            optional persistent cache of addresses
+
+        Returns
+        -------
+        List of errors of pools which still could not be geocoded, their amount is saved as geocode_errors
+        """
+        db = PoolDatabase()
+        pools = [Pool.import_obj(pool) for pool in db.get_pools_for_batch(self._id) if pool.get('address') is None]
+        parser = PoolAddressParser(self.key, HttpPool(max_connections=workers, rate_limit=rate_limit,
+                                                      max_retries=max_retries), workers, cache)
+        errors = []
+        try:
+            for start in tqdm(range(0, len(pools), chunk_size)):
+                chunk = pools[start:start + chunk_size]
+                errors += Pool.find_addresses(chunk, parser)
+                db.set_pool_addresses([(pool._id, pool.address) for pool in chunk if pool.address is not None])
+        finally:
+            parser.close()
+        self.geocode_errors = len(errors)
+        db.update_batch(self._id, { 'geocode_errors': self.geocode_errors })
+        return errors
+
+    def scan_coarse(self, db, levels, workers=1, sleep_range=None, margin=2, cell=4, queue_size=16):
+        """ Scan Coarse
+        Scans the polygon at zoomLevel - levels and marks unfinished tiles which do not overlap
+        any candidate pool pixels as done and skipped, so they are never fetched at full zoom.
+        Tiles reaching areas not seen on coarse photos are never skipped. The scan is claimed by
+        setting adaptive_zoom of the batch, so only one worker scans it; others do not wait and
+        fetch tiles at full zoom until they are skipped.
+
+        Parameters
+        ----------
+        db : PoolDatabase
+            database of the batch
+        levels : integer
+            how many zoom levels lower the polygon is scanned
+        workers : integer
+            amount of concurrent downloads of coarse photos
+        sleep_range : list
+            if given, random sleep from this range is made before every download
+        margin : integer
+            candidate pixels are dilated by margin coarse pixels, as pools get blurred at lower zoom
+        cell : integer
+            candidates are kept as cells of cell x cell coarse pixels
+        queue_size : integer
+            maximal amount of downloaded photos waiting for the scan
+
+        Returns
+        -------
+        Amount of skipped tiles, 0 if the batch was already scanned by other worker
+        """
+        if not db.claim_coarse_scan(self._id, levels):
+            return 0
+        self.adaptive_zoom = levels
+        coarse_zoom = max(1, self.zoomLevel - levels)
+        scale = 2 ** (self.zoomLevel - coarse_zoom)
+        coarse = self.ai.with_zoom(coarse_zoom)
+        # height and width in this order, so coarse photos touch each other
+        coords = coverPolygon(self.nodes, coarse_zoom, self.height, self.width)
+        kernel = np.ones((2 * margin + 1, 2 * margin + 1), dtype=np.uint8)
+
+        def fetch(coord):
+            if sleep_range is not None:
+                time.sleep(random.uniform(sleep_range[0], sleep_range[1]))
+            return coord, coarse.get_array(coord[0], coord[1])
+
+        def scan(item):
+            coord, photo = item
+            mask = cv.dilate(pool_mask(cv.cvtColor(np.ascontiguousarray(photo), cv.COLOR_RGB2HSV)), kernel)
+            x, y = _LatLongToPixelXY(coord[0], coord[1], coarse_zoom)
+            left, top = x - self.width // 2, y - self.height // 2
+            ys, xs = np.nonzero(mask)
+            if len(xs) == 0:
+                return left, top, None
+            return left, top, np.unique((top + ys) // cell << 32 | (left + xs) // cell)
+
+        # top left corners of photos in global pixel coordinates of coarse zoom,
+        # grouped by (left // width, top // height)
+        photos = {}
+        # candidate cells in global pixel coordinates of coarse zoom, encoded as y << 32 | x
+        cells = []
+        pipeline = Pipeline([
+            Stage('fetch', fetch, workers, queue_size),
+            Stage('scan', scan, 1, queue_size)
+        ])
+        for left, top, photo_cells in pipeline.run(coords):
+            photos.setdefault((left // self.width, top // self.height), []).append((left, top))
+            if photo_cells is not None:
+                cells.append(photo_cells)
+        candidates = np.unique(np.concatenate(cells)) if cells else np.zeros(0, dtype=np.int64)
+
+        def contains(ids, values):
+            if len(values) == 0:
+                return np.zeros(len(ids), dtype=bool)
+            return values[np.minimum(np.searchsorted(values, ids), len(values) - 1)] == ids
+
+        def seen(x0, x1, y0, y1):
+            # all cells x0..x1, y0..y1 lie completely on some photo
+            covered = np.zeros((y1 - y0 + 1, x1 - x0 + 1), dtype=bool)
+            for bx in range(x0 * cell // self.width - 1, ((x1 + 1) * cell - 1) // self.width + 1):
+                for by in range(y0 * cell // self.height - 1, ((y1 + 1) * cell - 1) // self.height + 1):
+                    for left, top in photos.get((bx, by), []):
+                        cx0, cx1 = max(-(-left // cell), x0), min((left + self.width) // cell, x1 + 1)
+                        cy0, cy1 = max(-(-top // cell), y0), min((top + self.height) // cell, y1 + 1)
+                        if cx0 < cx1 and cy0 < cy1:
+                            covered[cy0 - y0:cy1 - y0, cx0 - x0:cx1 - x0] = True
+            return covered.all()
+
+        tiles = db.get_tiles(self._id)
+        skipped = []
+        if len(tiles) > 0:
+            x, y = _LatLongToPixelXYArray(np.array([tile[1][0] for tile in tiles]),
+                                          np.array([tile[1][1] for tile in tiles]), self.zoomLevel)
+            left, top = x - self.width // 2, y - self.height // 2
+            # first and last candidate cell covered by every tile
+            x0, x1 = left // scale // cell, (left + self.width - 1) // scale // cell
+            y0, y1 = top // scale // cell, (top + self.height - 1) // scale // cell
+            for tile, tx0, tx1, ty0, ty1 in zip(tiles, x0, x1, y0, y1):
+                ids = (np.arange(ty0, ty1 + 1)[:, None] << 32 | np.arange(tx0, tx1 + 1)).ravel()
+                if not contains(ids, candidates).any() and seen(int(tx0), int(tx1), int(ty0), int(ty1)):
+                    skipped.append(tile[0])
+        return db.mark_tiles_done(self._id, skipped, skipped=True)
+
+    def heartbeat(self, db, machine_id, lease_seconds, stop):
+        """
+        Renews leases of the machine until stop event is set.
+        """
+        while not stop.wait(lease_seconds / 3):
+            db.renew_leases(self._id, machine_id, lease_seconds)
+
+    def fit(self, coverage=1, sleep_range=[0, 1], working_machine=None, workers=1, rate_limit=None, max_retries=5,
+            lease_size=15, lease_seconds=300, detect_workers=1, geocode_workers=1, queue_size=16, detect_processes=0,
+            adaptive_zoom=0, dedupe_radius=0, geocode_rate_limit=None, geocode_cache=None, blob_method='contours'):
+        """
+        Detects pools on tiles of the batch. Tiles stream through pipeline of stages
+        fetch -> detect -> dedupe -> geocode -> persist, each with own workers (workers is amount of fetch workers)
+        and bounded input queue of queue_size, so downloads and geocoding overlap with detection.
+        Persist stage handles tiles in lease order, so pools are the same as with one worker per stage.
+        If detect_processes is given, detection runs in that many worker processes (DetectorPool)
+        instead of detect stage threads.
+
+        blob_method chooses how pool colored pixels are turned into pools (see find_pools). With default
+        'contours' holes inside pools bigger than 5 pixels (e.g. trees over water) are reported as separate
+        pools, like in previous versions. 'components' reports one pool per blob and is faster on tiles
+        with many candidates, but results differ from batches detected before, so it has to be asked for.
+
+        If adaptive_zoom is given, the polygon is first scanned adaptive_zoom levels lower
+        (scan_coarse) and only tiles overlapping candidate pool pixels are fetched at full zoom,
+        the others are counted in tiles_skipped. Scan is made once per batch.
+
+        If dedupe_radius is given, pool closer than dedupe_radius meters to already found pool of the
+        batch (PoolIndex) is dropped before geocoding and counted in pools_merged. Dedupe stage handles
+        tiles in lease order, so the same pools are kept with any amount of workers. Dedupe is per machine:
+        the index holds pools saved before the run and pools found by this machine, so duplicates found
+        at the same time by other machines on neighbouring tiles are kept.
+
+        Pools of every tile are geocoded in bulk by one PoolAddressParser with geocode_workers
+        concurrent keep-alive requests limited by geocode_rate_limit requests per second.
+        Addresses are taken from geocode_cache (GeocodeCache) if it is given. Pools which could not be
+        geocoded are saved without address and counted in geocode_errors, geocode_pools retries them.
+
+        With one fetch worker and no rate limit photos from Bing are downloaded with random sleep from
+        sleep_range, otherwise over keep-alive connections limited by rate_limit requests per second.
+
+        Tiles are leased in chunks of lease_size, so any number of machines (with different
+        working_machine ids) can work on the same batch at once. Leases of a worker that stopped
+        sending heartbeats expire after lease_seconds and are taken by others. Without working_machine
+        a random id is used for this run.
+        """
+        if self._id is None or self.todo is not None:
+            self.export_to_db()
         self.update()
-        if self.is_working:
+        if self.is_working and not self.working_machines:
             raise Exception('Already running')
+        if working_machine is None:
+            working_machine = uuid.uuid4().hex
         self.is_working = True
         self.working_machine = working_machine
         self.progress = 0
         self.osm_done = False
-        self.export_to_db()
+        if blob_method not in blob_methods:
+            raise Exception(f'Unknown blob method {blob_method}')
+        db = PoolDatabase()
+        db.start_work(self._id, working_machine, { 'osm_done': False })
+        detector_pool = DetectorPool(detect_processes, blob_method) if detect_processes else None
+        parser = PoolAddressParser(self.key, HttpPool(max_connections=geocode_workers, rate_limit=geocode_rate_limit,
+                                                      max_retries=max_retries), geocode_workers, geocode_cache)
+        stop = threading.Event()
+        threading.Thread(target=self.heartbeat, args=(db, working_machine, lease_seconds, stop), daemon=True).start()
 
-        todo = list(filter(lambda c: random.random() < coverage, self.todo))
-        self.pool_buffer = []
-        for index, coord in tqdm(list(enumerate(todo))):
-            # update progress at database
-            if index % 15 == 0:
-                self.progress = index / len(todo)
-                self.export_to_db()
-            # random sleep
-            time.sleep(random.uniform(sleep_range[0], sleep_range[1]))
-            # detect pools
-            pd = PoolDetector(self.ai.get_photo(coord[0], coord[1]))
-            pd.get_pools()
-            middle_x = self.width//2
-            middle_y = self.height//2
+        bing = isinstance(self.ai, AerialImage)
+        throttle = bing and workers <= 1 and not rate_limit
+        if bing and not throttle:
+            self.ai.http = HttpPool(max_connections=workers, rate_limit=rate_limit, max_retries=max_retries)
+
+        def fetch(tile):
+            if throttle:
+                time.sleep(random.uniform(sleep_range[0], sleep_range[1]))
+            return tile, self.ai.get_array(tile[1][0], tile[1][1])
+
+        def detect(item):
+            (index, coord), photo = item
+            if detector_pool is not None:
+                pd = detector_pool.submit(photo).result()
+            else:
+                pd = PoolDetector(photo)
+                pd.get_pools(blob_method=blob_method)
+            pools = []
             if pd.pixel_coords is not None:
-                for pool_index, pool_coord in enumerate(np.floor(pd.pixel_coords)):
-                    x, y = _LatLongToPixelXY(coord[0],coord[1], self.zoomLevel)
-                    diff_x = pool_coord[0] - middle_x
-                    diff_y = pool_coord[1] - middle_y
-                    lat, long = _PixelXYToLatLong(x + diff_x, y + diff_y, self.zoomLevel)
+                lats, longs = _pools_lat_long(coord, pd.pixel_coords, self.zoomLevel, self.width, self.height)
+                for pool_index, (lat, long) in enumerate(zip(lats, longs)):
                     pool = Pool(lat, long, self._id)
                     pool.set_color(pd.mean_colors[pool_index].tolist())
-                    pool.find_address(self.key)
-                    self.pool_buffer.append(pool)
-            self.done.append(coord)
-            self.todo.remove(coord)
-            pd = None
-        self.progress = 1
-        self.is_working = False
-        self.export_to_db()
+                    pools.append(pool)
+            return index, pools
+
+        pool_index = None
+        if dedupe_radius:
+            pool_index = PoolIndex(self.zoomLevel, dedupe_radius, np.mean([node[0] for node in self.nodes]))
+            for coordinates in db.iter_pool_coordinates(self._id):
+                pool_index.add(*coordinates)
+
+        def dedupe(item):
+            if pool_index is None:
+                return item[0], item[1], 0
+            pools = [pool for pool in item[1] if pool_index.add(pool.coordinates[0], pool.coordinates[1])]
+            return item[0], pools, len(item[1]) - len(pools)
+
+        def geocode(item):
+            Pool.find_addresses(item[1], parser)
+            return item
+
+        done = []
+        merged = [0]
+        def persist(item):
+            tile_index, pools, duplicates = item
+            done.append((tile_index, pools))
+            merged[0] += duplicates
+            if len(done) >= 15:
+                self.checkpoint(db, done, expected, start_done, pipeline.stats(), merged[0], working_machine)
+                done.clear()
+                merged[0] = 0
+            return tile_index
+
+        pipeline = Pipeline([
+            Stage('fetch', fetch, workers, queue_size),
+            Stage('detect', detect, max(detect_workers, detect_processes), queue_size),
+            Stage('dedupe', dedupe, 1, queue_size, ordered=True),
+            Stage('geocode', geocode, geocode_workers, queue_size),
+            Stage('persist', persist, 1, queue_size, ordered=True)
+        ])
+        self.pool_buffer = []
+        try:
+            if adaptive_zoom and self.adaptive_zoom is None:
+                self.scan_coarse(db, adaptive_zoom, workers, sleep_range if throttle else None, queue_size=queue_size)
+            expected = round(db.count_free_tiles(self._id) * coverage)
+            start_done = db.get_batch_fields(self._id, ['tiles_done']).get('tiles_done') or 0
+            self.checkpoint(db, done, expected, start_done)
+            tiles = self.iter_leased_tiles(db, working_machine, coverage, lease_size, lease_seconds)
+            for _ in tqdm(pipeline.run(tiles), total=expected):
+                pass
+            self.checkpoint(db, done, expected, start_done, pipeline.stats(), merged[0], working_machine)
+        finally:
+            stop.set()
+            if detector_pool is not None:
+                detector_pool.close()
+            parser.close()
+            if bing and not throttle:
+                self.ai.http.close()
+                self.ai.http = None
+            db.finish_work(self._id, working_machine, lease_seconds)
+        self.update()
         return
@@ -1,18 +1,86 @@
 import math
-from shapely.geometry import Point
-from shapely.geometry.polygon import Polygon
 import numpy as np
 
+def _polygonRings(nodes):
+    """
+    Returns list of (n, 2) arrays of (lat, long) vertices of every ring of
+    polygon given as list of nodes, list of rings or shapely (Multi)Polygon.
+    """
+    if hasattr(nodes, 'geoms'):
+        return [ring for geom in nodes.geoms for ring in _polygonRings(geom)]
+    if hasattr(nodes, 'exterior'):
+        return [np.asarray(ring.coords, dtype=np.float64)[:, :2] for ring in [nodes.exterior, *nodes.interiors]]
+    if len(nodes) > 0 and np.ndim(nodes[0][0]) > 0:
+        return [ring for ring_nodes in nodes for ring in _polygonRings(ring_nodes)]
+    return [np.asarray(nodes, dtype=np.float64)[:, :2]]
+
+
+def _expandRanges(starts, ends):
+    """
+    Concatenates ranges [starts[k], ends[k]). Returns (range index, value) arrays.
+    """
+    counts = np.maximum(ends - starts, 0)
+    owners = np.repeat(np.arange(len(counts)), counts)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    return owners, starts[owners] + offsets
+
+
 def coverPolygon(nodes, zoomLevel, height, width):
-    if nodes[len(nodes) - 1] != nodes[0]:
-        nodes = nodes + [nodes[0]]
-    lats = list(map(lambda p: p[0], nodes))
-    lons = list(map(lambda p: p[1], nodes))
-    polygon = Polygon(list(map(lambda n: (n[0], n[1]), nodes)))
-    terr = coverTerrain(min(lats), max(lats), min(lons), max(lons), zoomLevel, height, width)
-    coords = terr.flatten().reshape(1, terr.shape[0] * terr.shape[1], 2)[0]
-    coords = list(filter(lambda c: polygon.contains(Point(c[0], c[1])), coords))
-    return list(map(lambda c: c.tolist(), coords))
+    """
+    Cover polygon with photos. Returns centers of the coverTerrain grid of
+    polygon's bounding box that lie inside the polygon.
+
+    Grid rows are rasterized with scanlines: crossings of every row with polygon
+    edges are computed at once and cells between pairs of crossings (even-odd rule)
+    are taken, so holes and multipolygons are supported and cells outside of the
+    polygon are never visited.
+
+    Parameters
+    ----------
+    nodes : list or shapely geometry
+        list of [lat, long] nodes, list of such rings or shapely Polygon/MultiPolygon
+        with (lat, long) coordinates
+    zoomLevel : integer
+        integer between [1,21], amount of zoom in the picture
+    height : integer
+        height of single aerial map in pixels.
+    width : integer
+        width of single aerial map in pixels
+
+    Returns
+    -------
+    numpy array of shape (n, 2) with [lat, long] photo centers ordered like flattened coverTerrain grid
+    """
+    rings = [ring for ring in _polygonRings(nodes) if len(ring) > 2]
+    if len(rings) == 0:
+        return np.zeros((0, 2))
+    vertices = np.concatenate(rings)
+    row_lats, col_lons = _coverAxes(vertices[:, 0].min(), vertices[:, 0].max(),
+                                    vertices[:, 1].min(), vertices[:, 1].max(), zoomLevel, height, width)
+
+    # edges of all closed rings
+    starts = np.concatenate([ring for ring in rings])
+    ends = np.concatenate([np.roll(ring, -1, axis=0) for ring in rings])
+
+    # rows crossed by every edge, half open to count shared vertices once
+    lats_asc = row_lats[::-1]
+    low = np.minimum(starts[:, 0], ends[:, 0])
+    high = np.maximum(starts[:, 0], ends[:, 0])
+    edge, row = _expandRanges(np.searchsorted(lats_asc, low, 'left'), np.searchsorted(lats_asc, high, 'left'))
+    lat = lats_asc[row]
+    a = starts[edge]
+    b = ends[edge]
+    lon = a[:, 1] + (lat - a[:, 0]) * (b[:, 1] - a[:, 1]) / (b[:, 0] - a[:, 0])
+
+    # every row has even amount of crossings, consecutive pairs bound inside spans
+    order = np.lexsort((lon, row))
+    row = row[order][::2]
+    lon = lon[order]
+    span, col = _expandRanges(np.searchsorted(col_lons, lon[::2], 'right'), np.searchsorted(col_lons, lon[1::2], 'left'))
+    row = len(row_lats) - 1 - row[span]
+
+    order = np.lexsort((row, col))
+    return np.stack([row_lats[row[order]], col_lons[col[order]]], axis=1)
 
 def coverTerrain(fromLat, toLat, fromLon, toLon, zoomLevel, height, width):
     """
@@ -44,9 +112,22 @@ def coverTerrain(fromLat, toLat, fromLon, toLon, zoomLevel, height, width):
 
     Returns
     -------
-    Matrix with
+    Matrix of shape (columns, rows, 2) with [lat, long] of every photo
     """
 
+    lats, lons = _coverAxes(fromLat, toLat, fromLon, toLon, zoomLevel, height, width)
+
+    cov = np.stack(np.broadcast_arrays(lats[None, :], lons[:, None]), axis=-1)
+
+    return cov
+
+
+def _coverAxes(fromLat, toLat, fromLon, toLon, zoomLevel, height, width):
+    """
+    Returns latitudes of coverTerrain grid rows and longitudes of its columns.
+    Latitude depends only on row and longitude only on column, so whole grid
+    is their cartesian product.
+    """
 
     _, py1 = _LatLongToPixelXY(fromLat, fromLon, zoomLevel)
     _, py2 = _LatLongToPixelXY(toLat, fromLon, zoomLevel)
@@ -60,15 +141,10 @@ def coverTerrain(fromLat, toLat, fromLon, toLon, zoomLevel, height, width):
     pxStart = min(px1, px2)
     pyStart = min(py1, py2)
 
-    cov = np.zeros((xInter, yInter, 2))
-    for i in range(yInter):
-        for j in range(xInter):
-            # not yet download photo, but rather return matrix
-            # add margin for watermark
-            lat_i, lon_i = _PixelXYToLatLong(pxStart + j * width, pyStart + i * height, zoomLevel)
-            cov[j, i] = [lat_i, lon_i]
+    lats, _ = _PixelXYToLatLongArray(pxStart, pyStart + np.arange(yInter) * height, zoomLevel)
+    _, lons = _PixelXYToLatLongArray(pxStart + np.arange(xInter) * width, pyStart, zoomLevel)
 
-    return cov
+    return lats, lons
 
 EarthRadius = 6378137
 MinLatitude = -85.05112878
@@ -215,4 +291,66 @@ def _TileXYToPixelXY(tileX, tileY):
     pixelX = tileX * 256
     pixelY = tileY * 256
 
-    return pixelX, pixelY
\ No newline at end of file
+    return pixelX, pixelY
+
+
+def _GroundResolutionArray(latitude, levelOfDetail):
+    """
+    Vectorized _GroundResolution. Accepts numpy arrays of latitudes.
+    """
+
+    latitude = np.clip(latitude, MinLatitude, MaxLatitude)
+    return np.cos(latitude * np.pi / 180) * 2 * np.pi * EarthRadius / _MapSize(levelOfDetail)
+
+
+def _LatLongToPixelXYArray(latitude, longitude, levelOfDetail):
+    """
+    Vectorized _LatLongToPixelXY. Accepts numpy arrays (or anything broadcastable)
+    of latitudes and longitudes and returns arrays of integer pixel coordinates.
+    """
+
+    latitude = np.clip(latitude, MinLatitude, MaxLatitude)
+    longitude = np.clip(longitude, MinLongitude, MaxLongitude)
+
+    x = (longitude + 180) / 360
+    sinLatitude = np.sin(latitude * np.pi / 180)
+    y = 0.5 - np.log((1 + sinLatitude) / (1 - sinLatitude)) / (4 * np.pi)
+    MapSize = _MapSize(levelOfDetail)
+
+    # values are non-negative after clipping, so floor truncates like int()
+    pixelX = np.floor(np.clip(x * MapSize + 0.5, 0, MapSize - 1)).astype(np.int64)
+    pixelY = np.floor(np.clip(y * MapSize + 0.5, 0, MapSize - 1)).astype(np.int64)
+
+    return pixelX, pixelY
+
+
+def _PixelXYToLatLongArray(pixelX, pixelY, levelOfDetail):
+    """
+    Vectorized _PixelXYToLatLong. Accepts numpy arrays (or anything broadcastable)
+    of pixel coordinates and returns arrays of latitudes and longitudes.
+    """
+
+    MapSize = _MapSize(levelOfDetail)
+    x = (np.clip(pixelX, 0, MapSize - 1) / MapSize) - 0.5
+    y = 0.5 - (np.clip(pixelY, 0, MapSize - 1) / MapSize)
+
+    latitude = 90 - 360 * np.arctan(np.exp(-y * 2 * np.pi)) / np.pi
+    longitude = 360 * x
+
+    return latitude, longitude
+
+
+def _PixelXYToTileXYArray(pixelX, pixelY):
+    """
+    Vectorized _PixelXYToTileXY.
+    """
+
+    return np.asarray(pixelX) / 256, np.asarray(pixelY) / 256
+
+
+def _TileXYToPixelXYArray(tileX, tileY):
+    """
+    Vectorized _TileXYToPixelXY.
+    """
+
+    return np.asarray(tileX) * 256, np.asarray(tileY) * 256
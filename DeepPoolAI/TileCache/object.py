@@ -0,0 +1,148 @@
+import hashlib
+import numbers
+import os
+import threading
+from collections import OrderedDict
+
+
+class TileCache:
+
+    def __init__(self, path, max_bytes=None, read_only=False):
+        """Tile Cache
+        Persistent cache of raw image bytes stored on disk. Every entry is a file
+        named after hash of the request parameters. When max_bytes is exceeded least
+        recently used files are removed.
+
+        Parameters
+        ----------
+        path : string
+            directory with cached files, created if missing
+        max_bytes : integer
+            maximal size of the cache in bytes, None means unbounded
+        read_only : boolean
+            if True, cache is never written nor evicted
+
+        Returns
+        -------
+        TileCache object
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.read_only = read_only
+        self.hits = 0
+        self.misses = 0
+        self.size = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        if not read_only:
+            os.makedirs(path, exist_ok=True)
+        self._load_index()
+
+    def _load_index(self):
+        files = []
+        if os.path.isdir(self.path):
+            for directory in os.listdir(self.path):
+                directory_path = os.path.join(self.path, directory)
+                if not os.path.isdir(directory_path):
+                    continue
+                for name in os.listdir(directory_path):
+                    if name.endswith('.tmp'):
+                        continue
+                    stat = os.stat(os.path.join(directory_path, name))
+                    files.append((stat.st_mtime, name, stat.st_size))
+        for _, name, size in sorted(files):
+            self.entries[name] = size
+            self.size += size
+
+    @staticmethod
+    def key(*params):
+        """
+        Returns key (hex digest) of the request described by params, e.g. (lat, long, zoomLevel, width, height).
+        Numbers are normalized first (integers as int, other numbers as float with 9 decimal places),
+        so numpy and Python numbers of the same tile give the same key.
+        """
+        normalized = []
+        for param in params:
+            if isinstance(param, numbers.Integral):
+                normalized.append(int(param))
+            elif isinstance(param, numbers.Real):
+                normalized.append(f'{float(param):.9f}')
+            else:
+                normalized.append(param)
+        return hashlib.sha1(repr(tuple(normalized)).encode()).hexdigest()
+
+    def _file(self, key):
+        return os.path.join(self.path, key[:2], key)
+
+    def get(self, key):
+        """
+        Returns cached bytes for the key or None if they are missing.
+        """
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(key)
+        try:
+            with open(self._file(key), 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            with self.lock:
+                self.size -= self.entries.pop(key, 0)
+                self.hits -= 1
+                self.misses += 1
+            return None
+        if not self.read_only:
+            os.utime(self._file(key))
+        return data
+
+    def put(self, key, data):
+        """
+        Stores bytes under the key and evicts least recently used entries if cache is too big.
+        """
+        if self.read_only:
+            return
+        file = self._file(key)
+        os.makedirs(os.path.dirname(file), exist_ok=True)
+        tmp = f"{file}.{threading.get_ident()}.tmp"
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, file)
+        evicted = []
+        with self.lock:
+            self.size += len(data) - self.entries.pop(key, 0)
+            self.entries[key] = len(data)
+            while self.max_bytes is not None and self.size > self.max_bytes and len(self.entries) > 1:
+                old_key, old_size = self.entries.popitem(last=False)
+                self.size -= old_size
+                evicted.append(old_key)
+        for old_key in evicted:
+            try:
+                os.remove(self._file(old_key))
+            except FileNotFoundError:
+                pass
+
+    def get_or_fetch(self, key, fetch):
+        """
+        Returns cached bytes for the key, calls fetch() and stores its result on miss.
+        """
+        data = self.get(key)
+        if data is None:
+            data = fetch()
+            self.put(key, data)
+        return data
+
+    def stats(self):
+        """
+        Returns dictionary with hits, misses, hit rate, amount of entries and size in bytes.
+        """
+        with self.lock:
+            requests = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / requests if requests else 0,
+                'entries': len(self.entries),
+                'bytes': self.size
+            }
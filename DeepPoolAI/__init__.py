@@ -1,19 +1,37 @@
-from .SateliteImages.object import AerialImage, GridPhotos, PolygonPhotos
-from .PoolDetector.object import PoolDetector
-from .PoolAddressParser.object import PoolAddressParser
-from .PoolPolygonsFinder.object import PoolPolygonsFinder
-from .PoolDatabase.object import PoolDatabase
-from .AdminServer.object import AdminServer
-from .ClientServer.object import ClientServer
+import importlib
 
-__all__ = [
-    "AerialImage",
-    "GridPhotos",
-    "PoolDatabase",
-    "PoolDetector",
-    "PoolAddressParser",
-    "PoolPolygonsFinder",
-    "PolygonPhotos",
-    "AdminServer",
-    "ClientServer"
-]
+# public names and submodules defining them, submodules (and their heavy dependencies
+# like cv2, pandas or flask) are imported on first access of the name
+_exports = {
+    "AerialImage": ".SateliteImages.object",
+    "ImageryProvider": ".SateliteImages.object",
+    "LocalMosaicProvider": ".SateliteImages.object",
+    "GridPhotos": ".SateliteImages.object",
+    "PoolDatabase": ".PoolDatabase.object",
+    "PoolDetector": ".PoolDetector.object",
+    "BatchDetector": ".PoolDetector.object",
+    "DetectorPool": ".PoolDetector.object",
+    "PoolAddressParser": ".PoolAddressParser.object",
+    "PoolPolygonsFinder": ".PoolPolygonsFinder.object",
+    "PolygonPhotos": ".SateliteImages.object",
+    "AdminServer": ".AdminServer.object",
+    "ClientServer": ".ClientServer.object",
+    "TileCache": ".TileCache.object",
+    "GeocodeCache": ".GeocodeCache.object",
+    "BoundaryStore": ".BoundaryStore.object",
+    "OverpassScheduler": ".OverpassScheduler.object"
+}
+
+__all__ = list(_exports)
+
+
+def __getattr__(name):
+    if name not in _exports:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(_exports[name], __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(list(globals()) + __all__)
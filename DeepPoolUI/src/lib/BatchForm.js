@@ -38,5 +38,67 @@ export default [
       },
       type: 'integer'
     }
+  },
+  {
+    type: 'number',
+    name: 'workers',
+    fullName: 'Concurrent requests',
+    default: 1,
+    constraints: {
+      numericality: {
+        greaterThanOrEqualTo: 1,
+        lessThanOrEqualTo: 64
+      },
+      type: 'integer'
+    }
+  },
+  {
+    type: 'number',
+    name: 'rate_limit',
+    fullName: 'Requests per second (0 - no limit)',
+    default: 0,
+    constraints: {
+      numericality: {
+        greaterThanOrEqualTo: 0,
+        lessThanOrEqualTo: 1000
+      },
+      type: 'number'
+    }
+  },
+  {
+    type: 'number',
+    name: 'adaptive_zoom',
+    fullName: 'Coarse scan levels (0 - off)',
+    default: 0,
+    constraints: {
+      numericality: {
+        greaterThanOrEqualTo: 0,
+        lessThanOrEqualTo: 4
+      },
+      type: 'integer'
+    }
+  },
+  {
+    type: 'number',
+    name: 'dedupe_radius',
+    fullName: 'Merge pools closer than (meters, 0 - off)',
+    default: 0,
+    constraints: {
+      numericality: {
+        greaterThanOrEqualTo: 0,
+        lessThanOrEqualTo: 100
+      },
+      type: 'number'
+    }
+  },
+  {
+    type: 'text',
+    name: 'blob_method',
+    fullName: 'Pool shapes (contours / components)',
+    default: 'contours',
+    constraints: {
+      inclusion: ['contours', 'components'],
+      type: 'string'
+    }
   }
 ]
@@ -0,0 +1,74 @@
+// Decoding of polygons exported by PoolPolygonsFinder.save_ui_polygons(compact=True):
+// every polygon has list of zooms and for each of them rings encoded as polylines
+
+export function decodePolyline (text, precision) {
+  const factor = Math.pow(10, precision)
+  const points = []
+  let lat = 0
+  let lng = 0
+  let index = 0
+  while (index < text.length) {
+    const deltas = [0, 0]
+    for (let k = 0; k < 2; k++) {
+      // plain arithmetic instead of bit operators, which overflow 32 bits with precision above 6
+      let value = 0
+      let scale = 1
+      let chunk
+      do {
+        chunk = text.charCodeAt(index++) - 63
+        value += (chunk % 32) * scale
+        scale *= 32
+      } while (chunk >= 32)
+      deltas[k] = value % 2 ? -(value + 1) / 2 : value / 2
+    }
+    lat += deltas[0]
+    lng += deltas[1]
+    points.push([lat / factor, lng / factor])
+  }
+  return points
+}
+
+// Returns polygons of compact export with levels of detail, which are decoded when they are first needed
+// (see nodesForZoom), polygons of full export are returned unchanged
+export function decodePolygons (data) {
+  if (Array.isArray(data)) {
+    return data
+  }
+  return data.polygons.map(p => ({
+    id: p.id,
+    name: p.name,
+    level: p.level,
+    pools: p.pools,
+    precision: data.precision,
+    lods: p.zooms.map((zoom, index) => ({ zoom, encoded: p.nodes[index], nodes: null }))
+  }))
+}
+
+// Returns rings of the polygon simplified for the map zoom
+export function nodesForZoom (polygon, zoom) {
+  if (!polygon.lods) {
+    return polygon.nodes
+  }
+  const lod = polygon.lods.find(l => zoom <= l.zoom) || polygon.lods[polygon.lods.length - 1]
+  if (!lod.nodes) {
+    lod.nodes = lod.encoded.map(ring => decodePolyline(ring, polygon.precision))
+  }
+  return lod.nodes
+}
+
+export function featureCollection (nodes) {
+  return {
+    type: 'FeatureCollection',
+    features: nodes.map(part => {
+      return {
+        type: 'Feature',
+        geometry: {
+          type: 'Polygon',
+          coordinates: [
+            part.map(p => ([p[1], p[0]]))
+          ]
+        }
+      }
+    })
+  }
+}
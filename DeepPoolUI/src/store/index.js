@@ -2,13 +2,14 @@ import Vue from 'vue'
 import Vuex from 'vuex'
 // import pools from '@/assets/pools.json'
 import polygons from '@/assets/polygons.json'
+import { decodePolygons } from '@/lib/polygons.js'
 Vue.use(Vuex)
 
 const searchParams = new URLSearchParams(window.location.search)
 
 const state = {
   pools: [],
-  polygons,
+  polygons: decodePolygons(polygons),
   mapboxAuth: 'pk.eyJ1IjoicGlvdHJwaWF0eXN6ZWsiLCJhIjoiY2tpZG5uYjVhMHRsejJ5bzVhazIxeGl3YSJ9.Q8ak3Y5QYlif8U85VBPVwA',
   cart: [],
   server: searchParams.get('server'),
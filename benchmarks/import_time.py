@@ -0,0 +1,58 @@
+# Measures import time of DeepPoolAI entry points in fresh interpreters and checks
+# that heavy dependencies are loaded only by the parts that need them.
+# Usage: python benchmarks/import_time.py [repeats]
+import os
+import subprocess
+import sys
+import json
+
+HEAVY = ['cv2', 'matplotlib', 'pandas', 'IPython', 'overpy', 'shapely', 'flask', 'flask_cors', 'pymongo']
+
+# statement and heavy modules it must not load
+CASES = [
+    ('import DeepPoolAI', HEAVY),
+    ('from DeepPoolAI import TileCache', HEAVY),
+    ('from DeepPoolAI import PoolDatabase', ['cv2', 'matplotlib', 'pandas', 'IPython', 'overpy', 'shapely', 'flask']),
+    ('from DeepPoolAI import ClientServer', ['cv2', 'matplotlib', 'pandas', 'IPython', 'overpy', 'shapely']),
+    ('from DeepPoolAI import PolygonPhotos', ['matplotlib', 'pandas', 'IPython', 'overpy', 'shapely', 'flask']),
+    ('from DeepPoolAI import PoolPolygonsFinder', ['cv2', 'matplotlib', 'pandas', 'IPython', 'flask']),
+]
+
+PROBE = """
+import sys, time, json
+start = time.perf_counter()
+{statement}
+elapsed = time.perf_counter() - start
+print(json.dumps({{'seconds': elapsed, 'loaded': [m for m in {heavy!r} if m in sys.modules]}}))
+"""
+
+
+def measure(statement, repeats):
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    results = []
+    for _ in range(repeats):
+        output = subprocess.run([sys.executable, '-c', PROBE.format(statement=statement, heavy=HEAVY)],
+                                cwd=root, capture_output=True, text=True, check=True).stdout
+        results.append(json.loads(output.strip().splitlines()[-1]))
+    return min(result['seconds'] for result in results), results[-1]['loaded']
+
+
+def main():
+    repeats = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+    failed = False
+    for statement, forbidden in CASES:
+        try:
+            seconds, loaded = measure(statement, repeats)
+        except subprocess.CalledProcessError as e:
+            print(f"{statement:45} failed: {e.stderr.strip().splitlines()[-1]}")
+            failed = True
+            continue
+        unexpected = [module for module in loaded if module in forbidden]
+        failed = failed or len(unexpected) > 0
+        print(f"{statement:45} {seconds * 1000:8.1f} ms  loaded: {', '.join(loaded) or '-'}"
+              + (f"  UNEXPECTED: {', '.join(unexpected)}" if unexpected else ''))
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+# Compares join_ways with the previous closest pair implementation on large synthetic
+# relations (rings split into shuffled, partly reversed ways) and checks that rings are the same.
+# Usage: python benchmarks/join_ways.py [rings] [ways per ring]
+import math
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from DeepPoolAI.PoolPolygonsFinder.utils import join_ways
+
+
+def join_ways_closest_pair(ways):
+    # previous implementation, joins the closest pair of ways one by one
+    ways = ways.copy()
+    out_ways = []
+    while len(ways) > 1:
+        new_ways = []
+        for w in ways:
+            if w[0][0] == w[-1][0] and w[0][1] == w[-1][1]:
+                out_ways.append(w)
+            else:
+                new_ways.append(w)
+        ways = new_ways
+        if len(ways) <= 1:
+            continue
+        min_dist = (math.inf, None, None, None)
+        for w1 in range(len(ways)):
+            for w2 in range(w1 + 1, len(ways)):
+                for comb in range(4):
+                    p1 = ways[w1][0 if comb % 2 else -1]
+                    p2 = ways[w2][0 if comb < 2 else -1]
+                    dist = (p1[0] - p2[0])**2 + (p1[1] - p2[1])**2
+                    if dist < min_dist[0]:
+                        min_dist = (dist, w1, w2, comb)
+        way1 = ways[min_dist[1]].copy()
+        way2 = ways[min_dist[2]].copy()
+        if min_dist[3] % 2:
+            way1.reverse()
+        if min_dist[3] >= 2:
+            way2.reverse()
+        ways.pop(min_dist[2])
+        ways.pop(min_dist[1])
+        ways.append(way1 + way2)
+    if len(ways) == 1:
+        out_ways.append(ways[0])
+    return out_ways
+
+
+def relation(rings, ways_per_ring, points_per_way=20, seed=0):
+    rng = random.Random(seed)
+    ways = []
+    for ring in range(rings):
+        lat, long = rng.uniform(-60, 60), rng.uniform(-180, 180)
+        n = ways_per_ring * points_per_way
+        points = [(lat + math.sin(2 * math.pi * i / n), long + math.cos(2 * math.pi * i / n)) for i in range(n)]
+        points.append(points[0])
+        for i in range(ways_per_ring):
+            way = points[i * points_per_way:(i + 1) * points_per_way + 1]
+            ways.append(way[::-1] if rng.random() < 0.5 else way)
+    rng.shuffle(ways)
+    return ways
+
+
+def measure(func, ways):
+    start = time.perf_counter()
+    result = func(ways)
+    return time.perf_counter() - start, result
+
+
+def main():
+    rings = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    ways_per_ring = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    for scale in (1, 2, 4):
+        ways = relation(rings * scale, ways_per_ring)
+        new_time, new_rings = measure(join_ways, ways)
+        old_time, old_rings = measure(join_ways_closest_pair, ways)
+        same = old_rings == new_rings
+        print(f'{len(ways):6d} ways: closest pair {old_time:8.3f}s, endpoint hash {new_time:8.4f}s, '
+              f'{old_time / new_time:7.1f}x, same rings: {same}')
+        if not same:
+            sys.exit(1)
+    ways = relation(rings * 200, ways_per_ring)
+    new_time, _ = measure(join_ways, ways)
+    print(f'{len(ways):6d} ways: endpoint hash {new_time:8.4f}s')
+
+
+if __name__ == '__main__':
+    main()
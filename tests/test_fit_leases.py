@@ -0,0 +1,77 @@
+# Tests of tile leasing of PolygonPhotos.fit on in-memory MongoDB (mongomock) with
+# a local imagery provider, so no network or database server is needed.
+# Usage: python -m pytest tests or python tests/test_fit_leases.py
+import os
+import sys
+import time
+import unittest
+from unittest import mock
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from DeepPoolAI.PoolDatabase.object import PoolDatabase
+from DeepPoolAI.SateliteImages.object import ImageryProvider, PolygonPhotos
+
+try:
+    import mongomock
+except ImportError:
+    mongomock = None
+
+NODES = [[36.27, -115.17], [36.28, -115.17], [36.28, -115.155], [36.27, -115.155]]
+
+
+class EmptyProvider(ImageryProvider):
+    # photos without pools, slow enough for several heartbeats during the run
+
+    def __init__(self, zoomLevel, width, height, delay=0.02):
+        self.zoomLevel = zoomLevel
+        self.width = width
+        self.height = height
+        self.delay = delay
+
+    def get_photo(self, lat, long):
+        time.sleep(self.delay)
+        return np.zeros((self.height, self.width, 3), dtype=np.uint8)
+
+
+@unittest.skipIf(mongomock is None, 'requires mongomock')
+class FitLeasesTest(unittest.TestCase):
+
+    def setUp(self):
+        client = mongomock.MongoClient()
+        patcher = mock.patch('pymongo.MongoClient', lambda *args, **kwargs: client)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        PoolDatabase._reset_clients()
+        self.addCleanup(PoolDatabase._reset_clients)
+        self.db = PoolDatabase()
+
+    def new_batch(self):
+        batch = PolygonPhotos(NODES, 'key', 18, 400, 300, 'test', provider=EmptyProvider(18, 400, 300))
+        batch.export_to_db()
+        return PolygonPhotos.import_from_db('key', batch._id, provider=EmptyProvider(18, 400, 300))
+
+    def test_fit_without_machine_processes_all_tiles(self):
+        batch = self.new_batch()
+        batch.fit(1, [0, 0], lease_size=5, lease_seconds=0.3)
+        stored = self.db.get_batch(batch._id)
+        self.assertEqual(stored['tiles_done'], stored['tiles_total'])
+        self.assertEqual(stored['progress'], 1)
+        self.assertFalse(stored['is_working'])
+        self.assertEqual(self.db.count_free_tiles(batch._id), 0)
+
+    def test_owner_filters_skip_unleased_tiles(self):
+        batch = self.new_batch()
+        self.db.lease_tiles(batch._id, 'a', 5)
+        self.db.renew_leases(batch._id, None)
+        summary = self.db.lease_summary(batch._id)
+        self.assertEqual((summary['leased'], summary['machines']), (5, { 'a': 5 }))
+        self.assertEqual(self.db.mark_tiles_done(batch._id, list(range(10)), machine_id='b'), 0)
+        self.assertEqual(self.db.leased_tiles(batch._id, None, list(range(10))), [])
+        with self.assertRaises(Exception):
+            self.db.lease_tiles(batch._id, None, 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
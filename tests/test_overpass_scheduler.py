@@ -0,0 +1,151 @@
+# Tests of OverpassScheduler against a small local Overpass stand-in (http.server),
+# which can reject requests (429, 504) and answer slowly to keep queries running.
+# Usage: python -m pytest tests or python tests/test_overpass_scheduler.py
+import json
+import os
+import re
+import sys
+import threading
+import time
+import unittest
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from DeepPoolAI.OverpassScheduler.object import OverpassScheduler
+
+
+class FakeOverpass:
+
+    def __init__(self, statuses=(), delay=0):
+        # statuses of first requests, following requests are answered with empty result
+        self.statuses = list(statuses)
+        self.delay = delay
+        self.requests = []
+        self.active = 0
+        self.max_active = 0
+        self.lock = threading.Lock()
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers['Content-Length'])).decode()
+                with fake.lock:
+                    fake.requests.append(body)
+                    status = fake.statuses.pop(0) if fake.statuses else 200
+                    fake.active += 1
+                    fake.max_active = max(fake.max_active, fake.active)
+                try:
+                    time.sleep(fake.delay)
+                    data = json.dumps({ 'version': 0.6, 'elements': [] }).encode() if status == 200 else b''
+                    self.send_response(status)
+                    self.send_header('Content-Type', 'application/json')
+                    self.send_header('Content-Length', str(len(data)))
+                    self.end_headers()
+                    self.wfile.write(data)
+                finally:
+                    with fake.lock:
+                        fake.active -= 1
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = f'http://127.0.0.1:{self.server.server_port}/api/interpreter'
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def bboxes(self):
+        return [tuple(map(float, match.groups())) for match in
+                (re.search(r'\[bbox:([-\d.]+),([-\d.]+),([-\d.]+),([-\d.]+)\]', body) for body in self.requests) if match]
+
+
+def build(lat, lon, levels):
+    return f'[out:json][bbox:{lat[0]},{lon[0]},{lat[1]},{lon[1]}]; rel["admin_level"~"^({"|".join(map(str, levels))})$"]; out;'
+
+
+def run_threads(targets, gap=0.02):
+    threads = [threading.Thread(target=target) for target in targets]
+    for thread in threads:
+        thread.start()
+        time.sleep(gap)
+    for thread in threads:
+        thread.join()
+
+
+class OverpassSchedulerTest(unittest.TestCase):
+
+    def serve(self, statuses=(), delay=0):
+        fake = FakeOverpass(statuses, delay)
+        self.addCleanup(fake.close)
+        return fake
+
+    def test_rejected_requests_are_retried(self):
+        fake = self.serve([429, 504, 429])
+        scheduler = OverpassScheduler(fake.url, backoff=0.01)
+        scheduler.query('[out:json]; rel(id:1); out;')
+        stats = scheduler.stats()
+        self.assertEqual(len(fake.requests), 4)
+        self.assertEqual((stats['requests'], stats['retries'], stats['errors']), (4, 3, 0))
+
+    def test_error_after_max_retries_is_raised_and_not_reused(self):
+        fake = self.serve([504] * 4)
+        scheduler = OverpassScheduler(fake.url, max_retries=1, backoff=0.01)
+        for _ in range(2):
+            with self.assertRaises(Exception):
+                scheduler.query('[out:json]; rel(id:1); out;')
+        self.assertEqual(len(fake.requests), 4)
+        self.assertEqual(scheduler.stats()['errors'], 2)
+
+    def test_concurrent_identical_queries_are_sent_once(self):
+        fake = self.serve(delay=0.3)
+        scheduler = OverpassScheduler(fake.url)
+        results = []
+        run_threads([lambda: results.append(scheduler.query('[out:json]; rel(id:1);  out;'))] * 5, gap=0)
+        self.assertEqual(len(fake.requests), 1)
+        self.assertEqual(len(results), 5)
+        self.assertTrue(all(result is results[0] for result in results))
+        self.assertEqual(scheduler.stats()['coalesced'], 4)
+
+    def test_concurrency_is_limited(self):
+        fake = self.serve(delay=0.1)
+        scheduler = OverpassScheduler(fake.url, max_concurrent=2)
+        run_threads([lambda i=i: scheduler.query(f'[out:json]; rel(id:{i}); out;') for i in range(6)], gap=0)
+        self.assertEqual(len(fake.requests), 6)
+        self.assertLessEqual(fake.max_active, 2)
+
+    def test_queued_overlapping_bboxes_are_merged(self):
+        fake = self.serve(delay=0.3)
+        scheduler = OverpassScheduler(fake.url, max_concurrent=1)
+        run_threads([lambda: scheduler.query('[out:json]; rel(id:1); out;'),
+                     lambda: scheduler.bbox_query([36, 37], [-115, -114], [4, 6], build),
+                     lambda: scheduler.bbox_query([36.5, 37.5], [-114.5, -113.5], [4, 6], build)])
+        self.assertEqual(len(fake.requests), 2)
+        self.assertEqual(fake.bboxes(), [(36, -115, 37.5, -113.5)])
+        self.assertEqual(scheduler.stats()['merged'], 1)
+
+    def test_bbox_inside_running_query_waits_for_it(self):
+        fake = self.serve(delay=0.3)
+        scheduler = OverpassScheduler(fake.url)
+        run_threads([lambda: scheduler.bbox_query([36, 38], [-116, -114], [4, 6, 8], build),
+                     lambda: scheduler.bbox_query([36.5, 37], [-115.5, -115], [6], build)])
+        self.assertEqual(len(fake.requests), 1)
+        self.assertEqual(scheduler.stats()['covered'], 1)
+        scheduler.bbox_query([37.5, 38.5], [-115.5, -115], [6], build)
+        self.assertEqual(len(fake.requests), 2)
+
+    def test_finished_queries_are_bounded(self):
+        fake = self.serve()
+        scheduler = OverpassScheduler(fake.url, max_recent=2)
+        for i in range(5):
+            scheduler.query(f'[out:json]; rel(id:{i}); out;')
+        self.assertEqual(len(scheduler.queries), 2)
+        scheduler.query('[out:json]; rel(id:4); out;')
+        scheduler.query('[out:json]; rel(id:0); out;')
+        self.assertEqual(len(fake.requests), 6)
+
+
+if __name__ == '__main__':
+    unittest.main()